@@ -0,0 +1,316 @@
+"""
+This file benchmarks the hot paths of the program, so speedups and slowdowns can be measured instead of guessed at.
+
+Each benchmark times one path on the shipped HIV Gag, Drosophila white and yeast YML093W sequences, and on synthetic
+random sequences from 1 kb to 10 Mb at several mutation rate scales:
+    - one generation of each simulation engine (the stepper behind simulatate_genetic_evolution and the others)
+    - calculate_distance between a sequence and a mutated copy of it
+    - validate_nucleotide_sequence of the raw sequence text, and reading it back from a FASTA file
+    - the four simulate_* model functions run all the way to the genetic distance threshold (shipped genes only, with
+      the rates of their mutation rate files). The rates are already per 10^5 or 10^7 generations (the generations
+      per rate of the file), so each simulated generation stands for that many real generations: the simulation runs
+      one step per simulated generation and the generations per rate is only reported alongside, as sweep.py does.
+      A simulation that has not reached the threshold after a cap of simulated generations (e.g. a model that settles
+      below it) is stopped there and timed over the generations it ran
+
+For each one it reports the time per generation (or per call), the number of sites processed per second, and the peak
+memory allocated while it ran (traced with tracemalloc in a separate run, so the tracing does not slow down the timing).
+The results can be saved as a JSON baseline and later runs compared against it, flagging anything slower than the
+tolerance. Everything runs offline, with the synthetic sequences generated from a fixed seed.
+
+Example:
+    python benchmark.py --save-baseline benchmark_baseline.json
+    python benchmark.py --compare benchmark_baseline.json --tolerance 1.25
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from evolutionary_models import (ENGINES, MODELS, NUCLEOTIDES, NumpyStepper, PythonStepper, SparseStepper,
+                                 calculate_distance, compile_model, make_rng, model_parameters, simulate_GTR,
+                                 simulate_HKY85, simulate_JC, simulate_K2P)
+from instrumentation import RunObserver
+from sweep import DATA_DIRECTORY, GENES
+from validate_input import (load_sequence, read_fasta_records, read_generations_per_rate, read_mutation_rates,
+                            validate_nucleotide_sequence)
+
+## the synthetic sequence lengths and mutation rate scales benchmarked by default
+SYNTHETIC_LENGTHS = [1000, 10000, 100000, 1000000, 10000000]
+RATE_SCALES = [1.0, 0.1, 0.01]
+
+## the stepper of each simulation engine
+STEPPERS = {"python": PythonStepper, "numpy": NumpyStepper, "sparse": SparseStepper}
+
+## the model functions benchmarked on the shipped genes
+SIMULATE_FUNCTIONS = {"JC": simulate_JC, "K2P": simulate_K2P, "HKY85": simulate_HKY85, "GTR": simulate_GTR}
+
+## each benchmark repeats its work until it has run for at least this long, to smooth out timer noise
+MINIMUM_SECONDS = 0.2
+
+## the most simulated generations a simulate_* benchmark runs before it is stopped
+MAX_SIMULATED_GENERATIONS = 20000
+
+
+"""
+Raised by GenerationCap to stop a simulation that has run for the maximum number of generations
+"""
+class GenerationCapReached(Exception):
+    def __init__(self, generation: int):
+        super().__init__("Stopped after " + str(generation) + " generations")
+        self.generation = generation
+
+
+"""
+Observer (see instrumentation.py) that stops a simulation once it has run for the given number of generations
+"""
+class GenerationCap(RunObserver):
+    def sample(self, generation: int, stepper, window):
+        raise GenerationCapReached(generation)
+
+
+"""
+Function that makes a random nucleotide sequence of the given length, the same every time for the same seed
+"""
+def synthetic_sequence(length: int, seed: int = 0) -> list:
+    codes = np.random.default_rng(seed).integers(0, len(NUCLEOTIDES), length)
+    return list(np.array(NUCLEOTIDES)[codes])
+
+
+"""
+Function that times a piece of work, calling it until it has run for at least the minimum time (or the maximum number
+of calls), and then measures its peak memory with tracemalloc over one more call. The setup function makes a fresh
+state for the work before timing and before the memory run. Returns the seconds per call, the number of calls timed and
+the peak memory in bytes.
+"""
+def measure(setup, work, max_calls: int = 1000) -> tuple:
+    state = setup()
+    calls = 0
+    start = time.perf_counter()
+    while calls < max_calls:
+        work(state)
+        calls += 1
+        if time.perf_counter() - start >= MINIMUM_SECONDS:
+            break
+    seconds = (time.perf_counter() - start) / calls
+
+    state = setup()
+    tracemalloc.start()
+    work(state)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, calls, peak_memory
+
+
+"""
+Function that builds one result row, with the seconds taken per generation or per call
+"""
+def result(name: str, path: str, sequence: str, length: int, rate_scale: float, seconds: float, calls: int,
+           peak_memory: int, unit: str = "generation") -> dict:
+    return {"name": name, "path": path, "sequence": sequence, "length": length, "rate_scale": rate_scale,
+            "seconds": seconds, "per": unit, "calls": calls,
+            "sites_per_second": length / seconds if seconds > 0 else float("inf"), "peak_memory_bytes": peak_memory}
+
+
+"""
+Function that benchmarks one generation of a simulation engine's stepper. The simulation is first run for a few
+generations so the sequence is no longer identical to the original.
+"""
+def benchmark_engine(engine: str, nucleotide_sequence: list, sequence_name: str, rate_scale: float) -> dict:
+    parameters = {name: rate * rate_scale for name, rate in model_parameters().items()}
+    model_spec = compile_model("GTR", nucleotide_sequence, parameters=parameters)
+
+    def setup():
+        rng = make_rng(engine, np.random.SeedSequence(0))
+        stepper = STEPPERS[engine](model_spec, nucleotide_sequence.copy(), rng)
+        for generation in range(3):
+            stepper.step()
+        return stepper
+
+    seconds, calls, peak_memory = measure(setup, lambda stepper: stepper.step())
+    return result("engine/" + engine + "/" + sequence_name + "/rate-" + str(rate_scale), "engine/" + engine,
+                  sequence_name, len(nucleotide_sequence), rate_scale, seconds, calls, peak_memory)
+
+
+"""
+Function that benchmarks calculate_distance between a sequence and an unrelated random sequence of the same length
+"""
+def benchmark_distance(nucleotide_sequence: list, sequence_name: str) -> dict:
+    mutated_sequence = synthetic_sequence(len(nucleotide_sequence), seed=1)
+
+    seconds, calls, peak_memory = measure(lambda: None,
+                                          lambda state: calculate_distance(nucleotide_sequence, mutated_sequence))
+    return result("distance/" + sequence_name, "calculate_distance", sequence_name, len(nucleotide_sequence), None,
+                  seconds, calls, peak_memory, "call")
+
+
+"""
+Function that benchmarks validating the raw text of a sequence (in 60 character FASTA lines), and reading it from a
+FASTA file
+"""
+def benchmark_validation(nucleotide_sequence: list, sequence_name: str) -> list:
+    text = "".join(nucleotide_sequence)
+    raw_text = "\n".join(text[start:start + 60] for start in range(0, len(text), 60)) + "\n"
+
+    seconds, calls, peak_memory = measure(lambda: None, lambda state: validate_nucleotide_sequence(raw_text))
+    results = [result("validate/" + sequence_name, "validate_nucleotide_sequence", sequence_name,
+                      len(nucleotide_sequence), None, seconds, calls, peak_memory, "call")]
+
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, "sequence.fasta")
+        with open(file_name, 'w') as file:
+            file.write(">" + sequence_name + "\n" + raw_text)
+        seconds, calls, peak_memory = measure(lambda: None, lambda state: list(read_fasta_records(file_name)))
+    results.append(result("read_fasta/" + sequence_name, "read_fasta_records", sequence_name,
+                          len(nucleotide_sequence), None, seconds, calls, peak_memory, "call"))
+    return results
+
+
+"""
+Function that benchmarks one of the simulate_* model functions run all the way to the genetic distance threshold on a
+shipped gene (or for at most max_generations simulated generations), reporting the time per simulated generation. The
+rates are used as they are, one simulated generation per step; generations_per_item (the real generations each
+simulated generation stands for) is only recorded in the result.
+"""
+def benchmark_model(model: str, engine: str, gene: str, nucleotide_sequence: list, parameters: dict,
+                    generations_per_item: int = 1, max_generations: int = MAX_SIMULATED_GENERATIONS) -> dict:
+    generations = []
+    capped = []
+
+    def work(state):
+        random.seed(0)
+        try:
+            generations.append(len(SIMULATE_FUNCTIONS[model](nucleotide_sequence.copy(), engine, 1, parameters,
+                                                             observer=GenerationCap(max_generations))))
+        except GenerationCapReached as stop:
+            generations.append(stop.generation)
+            capped.append(True)
+
+    seconds, calls, peak_memory = measure(lambda: None, work, max_calls=1)
+    seconds_per_generation = seconds / generations[0]
+    row = result("simulate/" + model + "/" + engine + "/" + gene, "simulate_" + model + "/" + engine, gene,
+                 len(nucleotide_sequence), 1.0, seconds_per_generation, calls, peak_memory)
+    row["generations"] = generations[0]
+    row["generations_per_item"] = generations_per_item
+    row["capped"] = bool(capped)
+    return row
+
+
+"""
+Function that runs the whole benchmark suite, printing each result as it finishes. The pure Python paths are only run
+on sequences up to the given length, as they take seconds per generation on the longest synthetic sequences.
+"""
+def run_benchmarks(lengths: list = SYNTHETIC_LENGTHS, rate_scales: list = RATE_SCALES, engines: list = list(ENGINES),
+                   models: list = MODELS, max_python_length: int = 100000, simulate_engine: str = "numpy",
+                   max_generations: int = MAX_SIMULATED_GENERATIONS) -> list:
+    sequences = {}
+    for gene, (sequence_file, rates_file) in GENES.items():
+        sequences[gene] = load_sequence(os.path.join(DATA_DIRECTORY, sequence_file))
+    for length in lengths:
+        sequences["synthetic-" + str(length)] = synthetic_sequence(length)
+
+    results = []
+    for sequence_name, nucleotide_sequence in sequences.items():
+        slow_paths = len(nucleotide_sequence) <= max_python_length
+        for engine in engines:
+            if engine == "python" and not slow_paths:
+                continue
+            for rate_scale in rate_scales:
+                results.append(report(benchmark_engine(engine, nucleotide_sequence, sequence_name, rate_scale)))
+        if slow_paths:
+            results.append(report(benchmark_distance(nucleotide_sequence, sequence_name)))
+        for row in benchmark_validation(nucleotide_sequence, sequence_name):
+            results.append(report(row))
+
+    for gene, (sequence_file, rates_file) in GENES.items():
+        rates_file = os.path.join(DATA_DIRECTORY, rates_file)
+        for model in models:
+            results.append(report(benchmark_model(model, simulate_engine, gene, sequences[gene],
+                                                  read_mutation_rates(rates_file),
+                                                  read_generations_per_rate(rates_file), max_generations)))
+    return results
+
+
+"""
+Function that prints one result row as a line of the report, and returns it
+"""
+def report(row: dict) -> dict:
+    print(row["name"].ljust(48), ("%.3e s" % row["seconds"]).rjust(12),
+          ("%.3e sites/s" % row["sites_per_second"]).rjust(20),
+          ("%.1f MiB" % (row["peak_memory_bytes"] / 2 ** 20)).rjust(12))
+    sys.stdout.flush()
+    return row
+
+
+"""
+Function that saves the results as a JSON baseline, along with the machine they were measured on
+"""
+def save_baseline(results: list, file_name: str):
+    with open(file_name, 'w') as file:
+        json.dump({"machine": platform.platform(), "python": platform.python_version(), "numpy": np.__version__,
+                   "results": {row["name"]: row for row in results}}, file, indent=1)
+
+
+"""
+Function that compares the results against a saved baseline, printing the ratio of the new time to the baseline time
+of every benchmark in both. Returns the names of the benchmarks that got slower by more than the tolerance.
+"""
+def compare_to_baseline(results: list, file_name: str, tolerance: float = 1.25) -> list:
+    with open(file_name, 'r') as file:
+        baseline = json.load(file)["results"]
+
+    regressions = []
+    for row in results:
+        if row["name"] not in baseline:
+            continue
+        ratio = row["seconds"] / baseline[row["name"]]["seconds"]
+        memory_ratio = row["peak_memory_bytes"] / max(1, baseline[row["name"]]["peak_memory_bytes"])
+        flag = ""
+        if ratio > tolerance:
+            flag = "SLOWER"
+            regressions.append(row["name"])
+        elif ratio < 1 / tolerance:
+            flag = "faster"
+        print(row["name"].ljust(48), ("time x%.2f" % ratio).rjust(12), ("memory x%.2f" % memory_ratio).rjust(14), flag)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the simulation, distance and input hot paths")
+    parser.add_argument("--lengths", nargs="+", type=int, default=SYNTHETIC_LENGTHS)
+    parser.add_argument("--rate-scales", nargs="+", type=float, default=RATE_SCALES)
+    parser.add_argument("--engines", nargs="+", choices=list(ENGINES), default=list(ENGINES))
+    parser.add_argument("--models", nargs="+", choices=MODELS, default=MODELS)
+    parser.add_argument("--max-python-length", type=int, default=100000,
+                        help="longest sequence to run the pure Python paths on")
+    parser.add_argument("--simulate-engine", choices=list(ENGINES), default="numpy",
+                        help="engine to run the simulate_* model functions on")
+    parser.add_argument("--max-generations", type=int, default=MAX_SIMULATED_GENERATIONS,
+                        help="stop the simulate_* benchmarks after this many simulated generations")
+    parser.add_argument("--save-baseline", default=None, help="save the results as a JSON baseline to this file")
+    parser.add_argument("--compare", default=None, help="compare the results to the JSON baseline in this file")
+    parser.add_argument("--tolerance", type=float, default=1.25,
+                        help="flag benchmarks this many times slower than the baseline")
+    arguments = parser.parse_args()
+
+    results = run_benchmarks(arguments.lengths, arguments.rate_scales, arguments.engines, arguments.models,
+                             arguments.max_python_length, arguments.simulate_engine, arguments.max_generations)
+    if arguments.save_baseline is not None:
+        save_baseline(results, arguments.save_baseline)
+    if arguments.compare is not None:
+        regressions = compare_to_baseline(results, arguments.compare, arguments.tolerance)
+        if regressions:
+            print(len(regressions), "benchmarks are slower than the baseline")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
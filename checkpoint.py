@@ -0,0 +1,124 @@
+"""
+This file saves checkpoints of long running simulations, so a simulation that is stopped part way (a crash, or the node
+it runs on being preempted) can carry on from its latest checkpoint instead of starting over.
+
+A checkpoint holds everything the generation loop needs to carry on exactly where it was: the original and current
+sequence, the number of sites that differ, the consensus window (with any thresholds it has already crossed), the
+genetic distances by generation so far (or the
+state of the Trajectory they are recorded in) and the state of the random number generator. A resumed simulation draws
+the same random numbers as one that was never stopped, so its results are bit-identical.
+
+Checkpoints are compact npz files (one byte per site for the sequences). Each one is written to a temporary file first
+and then moved over the previous checkpoint, so a simulation stopped while saving still has its last complete
+checkpoint.
+"""
+
+import json
+import os
+import time
+
+import numpy as np
+
+
+"""
+Functions that get and set the state of a random number generator as a JSON string: a numpy Generator, a random.Random,
+or the random module itself
+"""
+def get_rng_state(rng) -> str:
+    if hasattr(rng, "bit_generator"):
+        return json.dumps(rng.bit_generator.state)
+    return json.dumps(rng.getstate())
+
+
+def set_rng_state(rng, state: str):
+    state = json.loads(state)
+    if hasattr(rng, "bit_generator"):
+        rng.bit_generator.state = state
+    else:
+        version, internal_state, gauss_next = state
+        rng.setstate((version, tuple(internal_state), gauss_next))
+
+
+"""
+A checkpoint file for one simulation. The generation loop (see run_generations in evolutionary_models.py) restores the
+simulation from the file if it exists, saves to it every so many generations and/or seconds, and removes it once the
+simulation has finished (unless it should be kept).
+"""
+class Checkpoint:
+    def __init__(self, path: str, every_generations: int = None, every_seconds: float = 300,
+                 remove_when_finished: bool = True):
+        if every_generations is None and every_seconds is None:
+            raise ValueError("A checkpoint needs to be saved every so many generations or seconds")
+        self.path = path
+        self.every_generations = every_generations
+        self.every_seconds = every_seconds
+        self.remove_when_finished = remove_when_finished
+        self.last_saved = time.monotonic()
+
+    ## whether a checkpoint should be saved now that the simulation has reached the given number of generations
+    def due(self, generations: int) -> bool:
+        if self.every_generations is not None and generations % self.every_generations == 0:
+            return True
+        return self.every_seconds is not None and time.monotonic() - self.last_saved >= self.every_seconds
+
+    def save(self, stepper, window, distance_by_generation):
+        state = {"stepper": type(stepper).__name__, "rng_state": get_rng_state(stepper.rng),
+                 "window_differences": np.array(window.differences, dtype=np.int64),
+                 "window_position": window.position, "window_count": window.count, "window_total": window.total,
+                 "window_crossings": np.array(list(window.crossings.values()), dtype=np.int64)}
+        state.update(stepper.get_state())
+        if hasattr(distance_by_generation, "get_state"):
+            state.update({"trajectory_" + name: value for name, value in distance_by_generation.get_state().items()})
+        else:
+            state["distances"] = np.array(distance_by_generation, dtype=np.float64)
+
+        ## write the whole checkpoint to a temporary file, then replace the previous checkpoint with it in one step
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, 'wb') as file:
+            np.savez(file, **state)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self.path)
+        self.last_saved = time.monotonic()
+
+    """
+    Restores the stepper, consensus window and genetic distances by generation from the checkpoint file. Returns False
+    if there is no checkpoint to resume from, and raises a ValueError if the checkpoint is of a different simulation.
+    """
+    def restore(self, stepper, window, distance_by_generation) -> bool:
+        if not os.path.exists(self.path):
+            return False
+
+        with np.load(self.path) as data:
+            state = {name: data[name] for name in data.files}
+        if str(state["stepper"]) != type(stepper).__name__:
+            raise ValueError("The checkpoint " + self.path + " was saved by a " + str(state["stepper"]) +
+                             ", not a " + type(stepper).__name__)
+        if not np.array_equal(state["original_sequence"], stepper.get_state()["original_sequence"]):
+            raise ValueError("The checkpoint " + self.path + " was saved from a different original sequence")
+        if len(state["window_differences"]) != window.size:
+            raise ValueError("The checkpoint " + self.path + " has " + str(len(state["window_differences"])) +
+                             " consensus generations, not " + str(window.size))
+
+        stepper.set_state(state)
+        set_rng_state(stepper.rng, str(state["rng_state"]))
+        window.differences = [int(differences) for differences in state["window_differences"]]
+        window.position = int(state["window_position"])
+        window.count = int(state["window_count"])
+        window.total = int(state["window_total"])
+        if window.thresholds is not None:
+            window.crossings = dict(zip(window.thresholds, (int(generations)
+                                                             for generations in state["window_crossings"])))
+
+        if hasattr(distance_by_generation, "set_state"):
+            distance_by_generation.set_state({name[len("trajectory_"):]: value for name, value in state.items()
+                                              if name.startswith("trajectory_")})
+        else:
+            distance_by_generation[:] = state["distances"].tolist()
+        self.last_saved = time.monotonic()
+        return True
+
+    ## the simulation has finished, so there is nothing left to resume
+    def finish(self):
+        if self.remove_when_finished and os.path.exists(self.path):
+            os.remove(self.path)
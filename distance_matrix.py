@@ -0,0 +1,316 @@
+"""
+This file calculates the genetic distances between every pair of a set of sequences at once (such as the replicates of
+a model, or the individuals of a population at some generation), instead of comparing two sequences at a time with
+calculate_distance, and corrects them for multiple substitutions at the same site under each evolutionary model, so the
+simulations can be checked against the number of substitutions per site the models predict.
+
+The sequences are packed 2 bits per nucleotide (see population.py). With the nucleotide codes A = 0, C = 1, G = 2 and
+T = 3, the XOR of two nucleotides is 0 if they are the same, 2 if they differ by a transition (A <--> G or C <--> T),
+and 1 or 3 if they differ by a transversion. So XOR-ing two packed sequences and masking the bits of each 2 bit field
+counts the transitions and transversions between them for 4 sites per byte, and the low bit of the first sequence
+tells the purine transitions from the pyrimidine ones. The packed bytes are worked on as 64 bit words (32 sites at a
+time), and the set bits counted with numpy's bitwise_count (or a lookup table on older numpy).
+
+The corrected distances are:
+    - "p": the proportion of sites that differ (the same as calculate_distance)
+    - "JC": the Jukes-Cantor (1969) distance
+    - "K2P": the Kimura 2-Parameter distance, from the proportions of transitions and transversions
+    - "HKY85": the Tamura-Nei (1993) distance, the distance for the HKY85 model (a special case of it), using the
+      nucleotide frequencies of the two sequences and the proportions of purine and pyrimidine transitions
+    - "GTR": the general time reversible distance, -trace(F log(F^-1 D)), where D is the symmetric 4 x 4 matrix of the
+      proportions of sites with each pair of nucleotides, and F the diagonal matrix of the nucleotide frequencies. D is
+      counted with one matrix multiplication of the one hot encoded sequences per block.
+A pair of sequences too far apart for a correction (its logarithm would be of a number that is not positive) gets an
+infinite distance.
+
+The matrix is computed a block of rows by a block of columns at a time, so the temporary arrays stay a few tens of
+megabytes however many sequences there are. It can be written to a .npy file as it is computed (read it back with
+np.load(file_name, mmap_mode="r")), and the packed sequences can themselves be a memory mapped array, so matrices larger
+than memory can be calculated.
+"""
+
+import os
+
+import numpy as np
+
+from evolutionary_models import NUCLEOTIDES, encode_sequence
+from instrumentation import RunObserver
+from population import pack_sequence, unpack_sequence
+
+DISTANCE_MODELS = ["p", "JC", "K2P", "HKY85", "GTR"]
+
+## the number of set bits of every byte, for counting them where numpy has no bitwise_count (before numpy 2.0)
+BIT_COUNTS = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint8)
+
+## the low bit of each 2 bit field of a 64 bit word
+LOW_BITS = np.uint64(0x5555555555555555)
+
+## the number of each nucleotide packed in every byte, one row per nucleotide code
+NUCLEOTIDE_COUNTS = np.array([[sum(((byte >> shift) & 3) == code for shift in (0, 2, 4, 6)) for byte in range(256)]
+                              for code in range(len(NUCLEOTIDES))], dtype=np.uint8)
+
+## how much memory the temporary arrays of a block are allowed to take together, in bytes
+BLOCK_BYTES = 32 * 2 ** 20
+
+
+"""
+Function that views packed sequences as 64 bit words (padding them with A up to a whole word), so the bitwise operations
+work on 32 sites at a time
+"""
+def as_words(packed: np.ndarray) -> np.ndarray:
+    padded = np.zeros(packed.shape[:-1] + (-(-packed.shape[-1] // 8) * 8,), dtype=np.uint8)
+    padded[..., :packed.shape[-1]] = packed
+    return padded.view(np.uint64)
+
+
+"""
+Function that counts the set bits of an array of 64 bit words along its last axis
+"""
+def count_bits(words: np.ndarray) -> np.ndarray:
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    return BIT_COUNTS[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+"""
+Function that counts the substitutions between every packed sequence of rows and every packed sequence of columns.
+Returns three rows x columns arrays: the number of purine transitions (A <--> G), pyrimidine transitions (C <--> T) and
+transversions.
+"""
+def count_substitutions(rows: np.ndarray, columns: np.ndarray) -> tuple:
+    first = as_words(rows)[:, None, :]
+    differences = first ^ as_words(columns)[None, :, :]
+    ## the fields are picked out in place in one more array the size of differences, so a block only ever holds two
+    ## (and the bit counts of one): a transversion is any field with its low bit set, and a transition a field of
+    ## exactly 10, whose high bit shifted down and OR-ed with its low bit, then XOR-ed with its low bit, leaves it set
+    fields = np.bitwise_and(differences, LOW_BITS)
+    transversion_count = count_bits(fields)
+    np.right_shift(differences, np.uint64(1), out=fields)
+    fields |= differences
+    fields ^= differences
+    fields &= LOW_BITS
+    del differences
+    transition_count = count_bits(fields)
+    ## the transitions from a nucleotide with its low bit clear (A or G) are the purine transitions
+    fields &= ~first
+    purine_count = count_bits(fields)
+    return purine_count, transition_count - purine_count, transversion_count
+
+
+"""
+Function that counts each nucleotide in every packed sequence of a sequences x bytes array, given the number of
+nucleotides in each sequence. Returns a sequences x 4 array.
+"""
+def nucleotide_counts(packed: np.ndarray, length: int) -> np.ndarray:
+    counts = np.stack([NUCLEOTIDE_COUNTS[code][packed].sum(axis=-1, dtype=np.int64)
+                       for code in range(len(NUCLEOTIDES))], axis=-1)
+    ## the padding at the end of each packed sequence is counted as A
+    counts[..., 0] -= packed.shape[-1] * 4 - length
+    return counts
+
+
+"""
+Function that counts how many sites of every pair of a block of rows and a block of columns (as sequences x sites
+arrays of nucleotide codes) hold each pair of nucleotides. Returns a rows x columns x 4 x 4 array.
+"""
+def count_nucleotide_pairs(rows: np.ndarray, columns: np.ndarray) -> np.ndarray:
+    codes = np.arange(len(NUCLEOTIDES), dtype=np.uint8)
+    ## one hot encodings (a row of sites per sequence and nucleotide) arranged so the counts of every pair come out of
+    ## one matrix multiplication, the columns' transposed as a view rather than a copy
+    first = (rows[:, None, :] == codes[None, :, None]).astype(np.float64).reshape(-1, rows.shape[-1])
+    second = (columns[:, None, :] == codes[None, :, None]).astype(np.float64).reshape(-1, columns.shape[-1])
+    pairs = (first @ second.T).reshape(len(rows), len(NUCLEOTIDES), len(columns), len(NUCLEOTIDES))
+    return np.rint(pairs.transpose(0, 2, 1, 3)).astype(np.int64)
+
+
+"""
+Function that calculates -weight * log(argument) for arrays of the terms of a corrected distance, which is infinite
+where the argument is not positive and 0 where the weight is 0 (a term for nucleotides that are not there)
+"""
+def log_term(weight, argument) -> np.ndarray:
+    weight, argument = np.broadcast_arrays(np.asarray(weight, dtype=np.float64), np.asarray(argument, dtype=np.float64))
+    term = np.full(weight.shape, np.inf)
+    positive = argument > 0
+    term[positive] = -weight[positive] * np.log(argument[positive])
+    term[weight == 0] = 0.0
+    return term
+
+
+"""
+Functions for the corrected distance of each model, from the proportions of sites that differ in each way. Each works on
+whole arrays of pairs at once.
+"""
+def jukes_cantor_distance(p_distance) -> np.ndarray:
+    return log_term(0.75, 1 - 4 * np.asarray(p_distance) / 3)
+
+
+def kimura_distance(transitions, transversions) -> np.ndarray:
+    transitions, transversions = np.asarray(transitions), np.asarray(transversions)
+    return log_term(0.5, 1 - 2 * transitions - transversions) + log_term(0.25, 1 - 2 * transversions)
+
+
+## the frequencies are arrays of the frequencies of A, C, G and T along their last axis
+def tamura_nei_distance(purine_transitions, pyrimidine_transitions, transversions, frequencies) -> np.ndarray:
+    frequencies = np.asarray(frequencies, dtype=np.float64)
+    a, c, g, t = (frequencies[..., code] for code in range(len(NUCLEOTIDES)))
+    purines, pyrimidines = a + g, c + t
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        purine_weight = np.where(a * g > 0, 2 * a * g / purines, 0.0)
+        pyrimidine_weight = np.where(c * t > 0, 2 * c * t / pyrimidines, 0.0)
+        transversion_weight = 2 * (purines * pyrimidines - purine_weight * pyrimidines / 2 -
+                                   pyrimidine_weight * purines / 2)
+        purine_argument = np.where(a * g > 0, 1 - purines * purine_transitions / (2 * a * g) -
+                                   transversions / (2 * purines), 1.0)
+        pyrimidine_argument = np.where(c * t > 0, 1 - pyrimidines * pyrimidine_transitions / (2 * c * t) -
+                                       transversions / (2 * pyrimidines), 1.0)
+        transversion_argument = np.where(purines * pyrimidines > 0,
+                                         1 - transversions / (2 * purines * pyrimidines), 1.0)
+
+    return (log_term(purine_weight, purine_argument) + log_term(pyrimidine_weight, pyrimidine_argument) +
+            log_term(transversion_weight, transversion_argument))
+
+
+## the divergences are arrays of 4 x 4 matrices of the proportion of sites with each pair of nucleotides
+def gtr_distance(divergences) -> np.ndarray:
+    divergences = np.asarray(divergences, dtype=np.float64)
+    divergences = (divergences + np.swapaxes(divergences, -1, -2)) / 2
+    frequencies = divergences.sum(axis=-1)
+
+    ## F^-1 D is similar to the symmetric matrix F^-1/2 D F^-1/2, so its logarithm comes from an eigendecomposition,
+    ## and -trace(F log(F^-1 D)) = -sum over i and k of F_i V_ik^2 log(eigenvalue_k). A nucleotide that is not in
+    ## either sequence gets an eigenvalue of 1, so it adds nothing.
+    missing = frequencies == 0
+    roots = np.sqrt(np.where(missing, 1.0, frequencies))
+    scaled = divergences / (roots[..., :, None] * roots[..., None, :])
+    scaled = scaled + np.eye(len(NUCLEOTIDES)) * missing[..., None]
+    eigenvalues, eigenvectors = np.linalg.eigh(scaled)
+
+    distances = np.full(frequencies.shape[:-1], np.inf)
+    valid = np.all(eigenvalues > 0, axis=-1)
+    weights = np.einsum("...i,...ik->...k", frequencies[valid], eigenvectors[valid] ** 2)
+    distances[valid] = -np.sum(weights * np.log(eigenvalues[valid]), axis=-1)
+    return distances
+
+
+"""
+Function that calculates the distances of one block of the matrix, between the packed sequences of rows and of columns
+"""
+def block_distances(model: str, rows: np.ndarray, columns: np.ndarray, length: int) -> np.ndarray:
+    if model == "GTR":
+        pairs = count_nucleotide_pairs(unpack_sequence(rows, length), unpack_sequence(columns, length))
+        return gtr_distance(pairs / length)
+
+    purine_transitions, pyrimidine_transitions, transversions = count_substitutions(rows, columns)
+    if model == "p":
+        return (purine_transitions + pyrimidine_transitions + transversions) / length
+    if model == "JC":
+        return jukes_cantor_distance((purine_transitions + pyrimidine_transitions + transversions) / length)
+    if model == "K2P":
+        return kimura_distance((purine_transitions + pyrimidine_transitions) / length, transversions / length)
+
+    ## the nucleotide frequencies of each pair are those of the two sequences together
+    frequencies = (nucleotide_counts(rows, length)[:, None, :] + nucleotide_counts(columns, length)[None, :, :]) / (
+        2 * length)
+    return tamura_nei_distance(purine_transitions / length, pyrimidine_transitions / length, transversions / length,
+                               frequencies)
+
+
+"""
+Function that calculates the matrix of the corrected distances (see DISTANCE_MODELS) between every pair of packed
+sequences of a sequences x bytes array, each holding length nucleotides. The matrix is computed block_rows rows by
+block_rows columns at a time (chosen to keep the temporary arrays to about BLOCK_BYTES together if not given), and is
+written to a .npy file as a memory mapped array if an output file is given, which is then returned instead of an in
+memory array.
+"""
+def packed_distance_matrix(packed: np.ndarray, length: int, model: str = "p", output_file: str = None,
+                           block_rows: int = None) -> np.ndarray:
+    if model not in DISTANCE_MODELS:
+        raise ValueError("Unknown distance model " + str(model) + ", expected one of " + ", ".join(DISTANCE_MODELS))
+    if length < 1:
+        raise ValueError("The sequences must hold at least 1 nucleotide")
+
+    n_sequences = len(packed)
+    if block_rows is None:
+        ## counting the substitutions of a block holds two rows x rows x padded bytes arrays and the bit counts of one
+        ## (an eighth of its size), and the GTR counts hold the one hot encodings of the rows and of the columns,
+        ## 4 x sites doubles each and the booleans they are made from (an eighth of that again) for every sequence
+        padded_bytes = -(-packed.shape[-1] // 8) * 8
+        block_rows = max(1, int(np.sqrt(BLOCK_BYTES / (2 * padded_bytes + padded_bytes // 8))))
+        if model == "GTR":
+            block_rows = max(1, min(block_rows, BLOCK_BYTES // (2 * 36 * length)))
+
+    if output_file is not None:
+        matrix = np.lib.format.open_memmap(output_file, mode="w+", dtype=np.float64, shape=(n_sequences, n_sequences))
+    else:
+        matrix = np.zeros((n_sequences, n_sequences))
+
+    ## the matrix is symmetric, so only the blocks on or above the diagonal are calculated
+    for row_start in range(0, n_sequences, block_rows):
+        rows = np.asarray(packed[row_start:row_start + block_rows])
+        for column_start in range(row_start, n_sequences, block_rows):
+            columns = np.asarray(packed[column_start:column_start + block_rows])
+            block = block_distances(model, rows, columns, length)
+            matrix[row_start:row_start + len(rows), column_start:column_start + len(columns)] = block
+            matrix[column_start:column_start + len(columns), row_start:row_start + len(rows)] = block.T
+
+    if output_file is not None:
+        matrix.flush()
+    return matrix
+
+
+"""
+Function that calculates the matrix of the corrected distances between every pair of a list of nucleotide sequences
+(lists of one character strings, or strings) of the same length, or of the rows of a sequences x sites array of
+nucleotide codes. See packed_distance_matrix for the other arguments.
+"""
+def distance_matrix(sequences, model: str = "p", output_file: str = None, block_rows: int = None) -> np.ndarray:
+    if isinstance(sequences, np.ndarray):
+        codes = sequences
+    else:
+        lengths = set(len(sequence) for sequence in sequences)
+        if len(lengths) > 1:
+            raise ValueError("The sequences must all be the same length to be compared, not " +
+                             ", ".join(str(length) for length in sorted(lengths)))
+        codes = np.array([encode_sequence(list(sequence)) for sequence in sequences], dtype=np.uint8)
+
+    if codes.ndim != 2 or len(codes) == 0:
+        raise ValueError("Expected one or more sequences to compare")
+    return packed_distance_matrix(pack_sequence(codes), codes.shape[1], model, output_file, block_rows)
+
+
+"""
+Observer (see instrumentation.py) for simulate_population that calculates the matrix of the corrected distances between
+the individuals of the population every so many generations. The mean distance between two different individuals is
+kept by generation in samples, and each matrix is saved to generation_<n>.npy in the directory if one is given.
+"""
+class PairwiseDistances(RunObserver):
+    def __init__(self, every: int = 1000, model: str = "p", directory: str = None):
+        super().__init__(every)
+        if model not in DISTANCE_MODELS:
+            raise ValueError("Unknown distance model " + str(model) + ", expected one of " + ", ".join(DISTANCE_MODELS))
+        self.model = model
+        self.directory = directory
+        self.samples = []
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def start(self, generation: int, stepper, window):
+        self.record(generation, stepper)
+
+    def sample(self, generation: int, stepper, window):
+        self.record(generation, stepper)
+
+    def finish(self, generation: int, stepper, window):
+        if not self.samples or self.samples[-1]["generation"] != generation:
+            self.record(generation, stepper)
+
+    def record(self, generation: int, stepper):
+        output_file = None
+        if self.directory is not None:
+            output_file = os.path.join(self.directory, "generation_" + str(generation) + ".npy")
+        matrix = packed_distance_matrix(stepper.sequences, stepper.sequence_length, self.model, output_file)
+
+        pairs = np.triu_indices(len(matrix), k=1)
+        mean_distance = float(np.mean(matrix[pairs])) if len(pairs[0]) else 0.0
+        self.samples.append({"generation": generation, "mean_distance": mean_distance})
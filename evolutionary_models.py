@@ -42,10 +42,21 @@ a mutation rate that is greater over a greater number of generations, so each ge
 represent a certain number of generations that have passed. This number is set in the main function, as it just needs to be
 recorded on the graph.
 
+Instead of inflating the mutation rates by hand, the model functions can also be given the real per generation rates and
+a number of generations per step k. The one generation mutation table is then turned into a rate matrix Q, and each
+simulated generation samples from P(k) = exp(Qk), so a run costs the same however many real generations it covers.
+
+Each model function can run on one of several simulation engines. The "python" engine is the original nucleotide by
+nucleotide loop described above. The "numpy" engine does exactly the same thing with the sequence held as an array of
+nucleotide codes, so a whole generation is mutated in a handful of vectorized operations. The "sparse" engine only visits the sites that
+mutate, which makes it much faster for the genes with low mutation rates.
+
 """
 
 import random
 
+import numpy as np
+
 """
 User defined constants
 """
@@ -81,6 +92,18 @@ beta_CG = 0
 # Mutation rate caused by T <--> G
 beta_GT = (.134 * JC_alpha * 8)
 
+## The names of the user defined mutation rates above, which can also be passed to the model functions as a dictionary
+PARAMETER_NAMES = ["JC_alpha", "K2P_alpha", "K2P_beta", "HKY85_alpha", "HKY85_beta",
+                   "alpha_AG", "alpha_CT", "beta_AC", "beta_AT", "beta_CG", "beta_GT"]
+
+## The order the nucleotides are encoded in when a sequence is stored as a uint8 array (A = 0, C = 1, G = 2, T = 3).
+## This is also the column order of the mutation tables, so a nucleotide's code indexes straight into its row
+NUCLEOTIDES = ['A', 'C', 'G', 'T']
+
+## lookup table from ASCII byte to nucleotide code, used to encode a whole sequence in one vectorized step
+NUCLEOTIDE_CODES = np.zeros(256, dtype=np.uint8)
+for code, nucleotide in enumerate(NUCLEOTIDES):
+    NUCLEOTIDE_CODES[ord(nucleotide)] = code
 
 
 """
@@ -107,56 +130,484 @@ def calculate_average_distance(partial_distance_by_generation: list) -> float:
 
 
 """
-Function to simulate any of the genetic evolutionary models given the table of mutation probabilities and the
-nucleotide sequence
+Functions to convert a nucleotide sequence held as a list of one character strings to a uint8 array of nucleotide
+codes, and back again
+"""
+def encode_sequence(nucleotide_sequence: list) -> np.ndarray:
+    return NUCLEOTIDE_CODES[np.frombuffer("".join(nucleotide_sequence).encode("ascii"), dtype=np.uint8)]
+
+
+def decode_sequence(encoded_sequence: np.ndarray) -> list:
+    return list(np.array(NUCLEOTIDES)[encoded_sequence])
+
+
+"""
+Function that converts a cumulative mutation table (dictionary of dictionaries) into a 4 x 4 array, where row i holds
+the cumulative probabilities of nucleotide i mutating to A, C, G and T, in that order
+"""
+def mutation_table_to_array(mutation_table: dict) -> np.ndarray:
+    return np.array([[mutation_table[source][target] for target in NUCLEOTIDES] for source in NUCLEOTIDES],
+                    dtype=np.float64)
+
+
+"""
+Function that converts a cumulative mutation table into a 4 x 4 array of the probability of nucleotide i mutating to
+nucleotide j in one generation (the diagonal is the probability of not mutating)
+"""
+def mutation_table_to_probabilities(mutation_table: dict) -> np.ndarray:
+    return np.diff(mutation_table_to_array(mutation_table), axis=1, prepend=0.0)
+
+
+"""
+Function that calculates the frequency of each nucleotide in a sequence, counting all four in one pass
+"""
+def calculate_nucleotide_frequencies(nucleotide_sequence: list) -> dict:
+    counts = np.bincount(encode_sequence(nucleotide_sequence), minlength=len(NUCLEOTIDES))
+    length = len(nucleotide_sequence)
+    return {nucleotide: int(counts[code]) / length for code, nucleotide in enumerate(NUCLEOTIDES)}
+
+
+"""
+Function that checks a cumulative mutation table (as a 4 x 4 array) can be used as a dartboard: every probability must
+be between 0 and 1, each row must never decrease, and each row must end at exactly 1. Mutation rates that are too
+large for a model make the probability of not mutating negative, which would otherwise silently skew the simulation.
 """
+def validate_cumulative_table(cumulative_table: np.ndarray, model: str):
+    for code, nucleotide in enumerate(NUCLEOTIDES):
+        row = cumulative_table[code]
+        if row[0] < 0 or np.any(np.diff(row) < 0):
+            raise ValueError("Invalid " + model + " mutation table: the probabilities of " + nucleotide +
+                             " mutating are not all between 0 and 1 " + str([float(probability) for probability in row]))
+        if row[-1] != 1:
+            raise ValueError("Invalid " + model + " mutation table: the probabilities of " + nucleotide +
+                             " mutating add up to " + str(row[-1]) + " instead of 1")
 
-def simulatate_genetic_evolution(mutation_table: dict, nucleotide_sequence: list) -> list:
-    ## create a copy of the original sequence to compare the mutated sequences to
-    original_sequence = nucleotide_sequence.copy()
+
+"""
+Function that builds Walker alias tables from a 4 x 4 array of mutation probabilities. For each nucleotide, a random
+number between 0 and 4 picks a column and a point within it: the nucleotide mutates to the column's nucleotide if the
+point is below the column's alias probability, and to the column's alias nucleotide otherwise, so sampling takes one
+random number and two lookups whatever the probabilities are.
+"""
+def build_alias_tables(probabilities: np.ndarray) -> tuple:
+    columns = probabilities.shape[1]
+    alias_probabilities = np.ones(probabilities.shape)
+    alias_nucleotides = np.tile(np.arange(columns, dtype=np.uint8), (len(probabilities), 1))
+
+    for code, row in enumerate(probabilities):
+        scaled = list(row * columns)
+        small = [column for column in range(columns) if scaled[column] < 1]
+        large = [column for column in range(columns) if scaled[column] >= 1]
+        while small and large:
+            column = small.pop()
+            alias = large.pop()
+            alias_probabilities[code][column] = scaled[column]
+            alias_nucleotides[code][column] = alias
+            scaled[alias] -= 1 - scaled[column]
+            (small if scaled[alias] < 1 else large).append(alias)
+
+    return alias_probabilities, alias_nucleotides
+
+
+"""
+A compiled evolutionary model, holding everything the simulation engines need to sample from it: the cumulative
+mutation table as a dictionary (for the pure Python engine) and as a checked array, the probabilities of each
+nucleotide mutating to each other nucleotide, and the alias tables built from them
+"""
+class ModelSpec:
+    def __init__(self, model: str, mutation_table: dict):
+        self.model = model
+        self.mutation_table = mutation_table
+        self.cumulative_table = mutation_table_to_array(mutation_table)
+        validate_cumulative_table(self.cumulative_table, model)
+        self.probabilities = np.diff(self.cumulative_table, axis=1, prepend=0.0)
+        self.alias_probabilities, self.alias_nucleotides = build_alias_tables(self.probabilities)
+
+
+"""
+The consensus generations kept as a fixed size ring of difference counts (number of sites that differ from the original
+sequence) with a running total, so checking whether the last n generations average at or above the genetic distance
+threshold costs the same however long the simulation has been running. The threshold can also be a list of thresholds,
+in which case the window is reached at the largest of them, and the number of generations at which the consensus
+generations first reached each of them is recorded in crossings as the simulation passes them.
+"""
+class ConsensusWindow:
+    def __init__(self, length: int, size: int = None, threshold=None):
+        self.length = length
+        self.size = consensus_generations if size is None else size
+        if isinstance(threshold, (list, tuple)):
+            ## a threshold given twice is only crossed once (crossings is keyed by threshold)
+            self.thresholds = sorted(set(threshold))
+            threshold = self.thresholds[-1]
+        else:
+            self.thresholds = None
+        self.threshold = threshold_genetic_distance if threshold is None else threshold
+        self.crossings = {}
+        self.differences = [0] * self.size
+        self.position = 0
+        self.count = 0
+        self.total = 0
+
+    ## add the difference count of the newest generation, dropping the oldest one once the window is full
+    def push(self, differences: int):
+        if self.count == self.size:
+            self.total -= self.differences[self.position]
+        else:
+            self.count += 1
+        self.differences[self.position] = differences
+        self.total += differences
+        self.position = (self.position + 1) % self.size
+
+    def average_distance(self) -> float:
+        return self.total / (self.count * self.length)
+
+    def reached(self) -> bool:
+        return self.average_distance() >= self.threshold
+
+    ## record every threshold the consensus generations have now reached for the first time, at the given number of
+    ## generations
+    def record_crossings(self, generations: int):
+        average_distance = self.average_distance()
+        for threshold in self.thresholds[len(self.crossings):]:
+            if average_distance < threshold:
+                break
+            self.crossings[threshold] = generations
+
+
+"""
+Function that runs the generation loop shared by the simulation engines. The stepper mutates its sequence by one
+generation each time step() is called and returns the number of sites that now differ from the original sequence, which
+it keeps up to date only at the sites that changed. The loop records the genetic distance of every generation and stops
+once the consensus generations average at or above the genetic distance threshold (the user defined threshold unless
+another one is given). The distances are recorded in a plain list, or in the given trajectory (see trajectory.py).
+Given a list of thresholds, the loop runs until the largest one is reached, and records the number of generations it
+took to reach each of them in the crossings dictionary (if one is given), keyed by threshold in increasing order.
+If a checkpoint is given (see checkpoint.py), the simulation resumes from it when it has been saved before, and is saved
+to it periodically as it runs. If an observer is given (see instrumentation.py), it is shown the stepper and consensus
+window at the start, every observer.every generations, and at the end of the simulation.
+"""
+def run_generations(stepper, threshold=None, trajectory=None, checkpoint=None, observer=None, crossings=None):
     ## create the list to store the genetic distances by generation, starting with the first generation having 0 distance
-    distance_by_generation = [0.0]
+    distance_by_generation = [] if trajectory is None else trajectory
+    window = ConsensusWindow(stepper.length, threshold=threshold)
+    multiple_thresholds = window.thresholds is not None
+    if checkpoint is None or not checkpoint.restore(stepper, window, distance_by_generation):
+        distance_by_generation.append(0.0)
+        window.push(0)
+        if multiple_thresholds:
+            window.record_crossings(1)
+    generation = len(distance_by_generation) - 1
+    if observer is not None:
+        observer.start(generation, stepper, window)
 
     ## while the average distance of the last n consensus generations is less than the genetic distance threshold, mutate to the next generation
-    while (calculate_average_distance(distance_by_generation[(-1 * consensus_generations):]) < threshold_genetic_distance):
+    while not window.reached():
+        differences = stepper.step()
+        distance_by_generation.append(differences / stepper.length)
+        window.push(differences)
+        generation += 1
+        if multiple_thresholds:
+            window.record_crossings(generation + 1)
+        if checkpoint is not None and checkpoint.due(generation + 1):
+            checkpoint.save(stepper, window, distance_by_generation)
+        if observer is not None and generation % observer.every == 0:
+            observer.sample(generation, stepper, window)
+
+    if checkpoint is not None:
+        checkpoint.finish()
+    if observer is not None:
+        observer.finish(generation, stepper, window)
+    if crossings is not None:
+        crossings.update(window.crossings if multiple_thresholds else {window.threshold: generation + 1})
+    ## once the consensus sequences average at or above the threshold, return the list of genetic distances by generation
+    return distance_by_generation
+
+
+"""
+Stepper that mutates a sequence held as a list of one character strings, one nucleotide at a time, by throwing a dart
+at the nucleotide's row of the cumulative mutation table
+"""
+class PythonStepper:
+    def __init__(self, model_spec: ModelSpec, nucleotide_sequence: list, rng=random):
+        self.mutation_table = model_spec.mutation_table
+        self.sequence = nucleotide_sequence
+        ## create a copy of the original sequence to compare the mutated sequences to
+        self.original_sequence = nucleotide_sequence.copy()
+        self.length = len(nucleotide_sequence)
+        self.rng = rng
+        self.differences = 0
+        ## the number of mutations applied so far, for instrumentation
+        self.mutations = 0
+
+    def step(self) -> int:
+        sequence = self.sequence
+        original_sequence = self.original_sequence
 
         ## iterate over the length of the nucleotide sequence
-        for i in range(len(nucleotide_sequence)):
+        for i in range(self.length):
 
             ## get a random number between 0 and 1 inclusive
-            random_float = random.random()
+            random_float = self.rng.random()
             ## get the nucleotide at the ith position
-            nucleotide = nucleotide_sequence[i]
+            nucleotide = sequence[i]
 
             ## get the mutation probabilities of that nucleotide for the givben mutation table
-            sub_table = mutation_table[nucleotide]
+            sub_table = self.mutation_table[nucleotide]
 
             ## find out what range the random float falls within
             ## if it falls within the range of the probability of the nucleotide mutating (or "mutating" to itself (prob. of not mutating)),
             ## set the nucleotide at that position to the corresponding nucleotide
             if (random_float <= sub_table['A']):
-                nucleotide_sequence[i] = 'A'
+                mutated = 'A'
             elif (random_float <= sub_table['C']):
-                nucleotide_sequence[i] = 'C'
+                mutated = 'C'
             elif (random_float <= sub_table['G']):
-                nucleotide_sequence[i] = 'G'
+                mutated = 'G'
             ## if it does not fall in the range of probabilities, then it falls in the probability of mutating to T
             else:
-                nucleotide_sequence[i] = 'T'
+                mutated = 'T'
 
-        ## calculate the genetic distance of the newly mutated sequence, and append it to the end of the distance_by_generation list
-        distance_by_generation.append(calculate_distance(
-            original_sequence, nucleotide_sequence))
+            ## only a site that changed can change the number of differences from the original sequence
+            if mutated != nucleotide:
+                sequence[i] = mutated
+                self.mutations += 1
+                if nucleotide == original_sequence[i]:
+                    self.differences += 1
+                elif mutated == original_sequence[i]:
+                    self.differences -= 1
 
-    ## once the consensus sequences average at or above the threshold, return the list of genetic distances by generation
+        return self.differences
+
+    ## the state of the simulation to save in a checkpoint, and restoring it (see checkpoint.py)
+    def get_state(self) -> dict:
+        return {"original_sequence": encode_sequence(self.original_sequence),
+                "sequence": encode_sequence(self.sequence), "differences": self.differences,
+                "mutations": self.mutations}
+
+    def set_state(self, state: dict):
+        self.sequence[:] = decode_sequence(state["sequence"])
+        self.differences = int(state["differences"])
+        self.mutations = int(state["mutations"])
+
+
+"""
+Stepper that mutates a sequence held as a uint8 array of nucleotide codes. One block of random numbers is drawn per
+generation, and every site is mapped through its row of the cumulative mutation table with a single vectorized lookup.
+Each site picks the first nucleotide whose cumulative probability is at or above its random number, exactly like the
+if/elif chain of the PythonStepper, so the same random numbers give the same sequence.
+"""
+class NumpyStepper:
+    def __init__(self, model_spec: ModelSpec, nucleotide_sequence: list, rng):
+        self.cumulative_table = model_spec.cumulative_table
+        self.original_sequence = encode_sequence(nucleotide_sequence)
+        self.sequence = self.original_sequence.copy()
+        self.length = len(self.sequence)
+        self.rng = rng
+        self.differences = 0
+        self.mutations = 0
+
+    def step(self) -> int:
+        ## one random number per site, compared against the cumulative probabilities of the nucleotide at that site;
+        ## the last column is always 1, so argmax finds the first range the random number falls within
+        random_floats = self.rng.random(self.length)
+        mutated = np.argmax(random_floats[:, None] <= self.cumulative_table[self.sequence], axis=1).astype(np.uint8)
+
+        sites = np.flatnonzero(mutated != self.sequence)
+        self.mutations += len(sites)
+        self.differences += count_difference_change(self.original_sequence[sites], self.sequence[sites], mutated[sites])
+        self.sequence = mutated
+        return self.differences
+
+    def get_state(self) -> dict:
+        return {"original_sequence": self.original_sequence, "sequence": self.sequence,
+                "differences": self.differences, "mutations": self.mutations}
+
+    def set_state(self, state: dict):
+        self.sequence = state["sequence"].astype(np.uint8)
+        self.differences = int(state["differences"])
+        self.mutations = int(state["mutations"])
+
+
+"""
+Stepper that only visits the sites that mutate. At low mutation rates almost every random number drawn by the other
+steppers is for a site that does not change, so instead this treats the generations x sites grid as one long line and
+draws geometric skip distances between candidate sites, using the largest probability of any nucleotide mutating as the
+candidate probability. Each candidate site then draws where in that probability its random number landed: if it falls
+within the site's own probabilities of mutating to another nucleotide it mutates to that nucleotide, otherwise it stays
+as it is. This gives every site exactly the probabilities of the mutation table, so it is statistically the same as
+throwing a dart at every site, while the work per generation scales with the number of mutations instead of the length
+of the sequence.
+"""
+class SparseStepper:
+    def __init__(self, model_spec: ModelSpec, nucleotide_sequence: list, rng):
+        ## probabilities of each nucleotide mutating to each other nucleotide, without the probability of staying the same
+        mutation_probabilities = model_spec.probabilities.copy()
+        np.fill_diagonal(mutation_probabilities, 0.0)
+        self.mutation_cumulative = np.cumsum(mutation_probabilities, axis=1)
+        self.candidate_probability = self.mutation_cumulative[:, -1].max()
+        if self.candidate_probability <= 0:
+            raise ValueError("The mutation table never mutates any nucleotide, so the simulation can never finish")
+
+        self.original_sequence = encode_sequence(nucleotide_sequence)
+        self.sequence = self.original_sequence.copy()
+        self.length = len(self.sequence)
+        self.rng = rng
+        self.differences = 0
+        self.mutations = 0
+
+        ## draw skip distances in blocks big enough to usually cover a couple of generations
+        self.block_size = max(64, int(2 * self.length * self.candidate_probability))
+        ## positions of the upcoming candidate sites, counted from the start of the current generation
+        self.candidate_sites = np.cumsum(rng.geometric(self.candidate_probability, self.block_size)) - 1
+
+    def step(self) -> int:
+        while self.candidate_sites[-1] < self.length:
+            self.candidate_sites = np.concatenate((self.candidate_sites, self.candidate_sites[-1] + np.cumsum(
+                self.rng.geometric(self.candidate_probability, self.block_size))))
+
+        ## take this generation's candidate sites and shift the rest to the start of the next generation
+        count = np.searchsorted(self.candidate_sites, self.length)
+        sites = self.candidate_sites[:count]
+        self.candidate_sites = self.candidate_sites[count:] - self.length
+
+        if count > 0:
+            nucleotides = self.sequence[sites]
+            random_floats = self.rng.random(count) * self.candidate_probability
+            ## the number of cumulative mutation probabilities at or below the random number is the nucleotide it
+            ## mutates to, and a random number past all of them (4) means the site does not mutate
+            mutated = np.count_nonzero(random_floats[:, None] >= self.mutation_cumulative[nucleotides], axis=1)
+            mutated = np.where(mutated == 4, nucleotides, mutated).astype(np.uint8)
+            self.mutations += int(np.count_nonzero(mutated != nucleotides))
+
+            self.differences += count_difference_change(self.original_sequence[sites], nucleotides, mutated)
+            self.sequence[sites] = mutated
+
+        return self.differences
+
+    def get_state(self) -> dict:
+        return {"original_sequence": self.original_sequence, "sequence": self.sequence,
+                "differences": self.differences, "mutations": self.mutations,
+                "candidate_sites": self.candidate_sites}
+
+    def set_state(self, state: dict):
+        self.sequence = state["sequence"].astype(np.uint8)
+        self.differences = int(state["differences"])
+        self.mutations = int(state["mutations"])
+        self.candidate_sites = state["candidate_sites"].astype(self.candidate_sites.dtype)
+
+
+"""
+Function that counts how much the number of differences from the original sequence changes when the nucleotides at a
+set of sites change from before to after
+"""
+def count_difference_change(original_nucleotides: np.ndarray, before: np.ndarray, after: np.ndarray) -> int:
+    return int(np.count_nonzero(after != original_nucleotides)) - int(np.count_nonzero(before != original_nucleotides))
+
+
+"""
+Function to simulate any of the genetic evolutionary models given the compiled model (or a plain cumulative table of
+mutation probabilities) and the nucleotide sequence. The random numbers come from the random module unless a
+random.Random instance is given, and the simulation runs to the user defined genetic distance threshold unless another
+threshold is given. The genetic distances by generation are returned as a list, or recorded in the given trajectory and
+returned in it. Long simulations can be given a checkpoint to save to and resume from (see checkpoint.py), and an
+observer to report on their progress (see instrumentation.py). The threshold can be a list of thresholds, with the
+number of generations taken to reach each one recorded in the given crossings dictionary (see run_generations).
+"""
+def simulatate_genetic_evolution(model_spec, nucleotide_sequence: list, rng=None, threshold=None, trajectory=None,
+                                 checkpoint=None, observer=None, crossings=None):
+    if rng is None:
+        rng = random
+
+    return run_generations(PythonStepper(as_model_spec(model_spec), nucleotide_sequence, rng), threshold, trajectory,
+                           checkpoint, observer, crossings)
+
+
+"""
+Function to simulate any of the genetic evolutionary models with NumPy instead of walking the sequence one nucleotide
+at a time (see NumpyStepper). The same random numbers give the same list of genetic distances by generation as
+simulatate_genetic_evolution. An optional numpy Generator can be given; otherwise one is seeded from the random module,
+so seeding the random module still makes a run repeatable.
+"""
+def simulate_genetic_evolution_numpy(model_spec, nucleotide_sequence: list, rng=None, threshold=None,
+                                     trajectory=None, checkpoint=None, observer=None, crossings=None):
+    if rng is None:
+        rng = np.random.default_rng(random.getrandbits(64))
+
+    stepper = NumpyStepper(as_model_spec(model_spec), nucleotide_sequence, rng)
+    distance_by_generation = run_generations(stepper, threshold, trajectory, checkpoint, observer, crossings)
+
+    ## leave the final sequence in the list that was passed in, like the pure Python simulation does
+    nucleotide_sequence[:] = decode_sequence(stepper.sequence)
     return distance_by_generation
 
 
 """
-Function to simulate the Jukes-Cantor Evolutionary model
-Takes an initial nucleotide sequence and a number of generations to simulate
+Function to simulate any of the genetic evolutionary models by only visiting the sites that mutate (see SparseStepper),
+which is statistically the same as the other engines but much faster at low mutation rates
 """
-def simulate_JC(nucleotide_sequence: list) -> list:
+def simulate_genetic_evolution_sparse(model_spec, nucleotide_sequence: list, rng=None, threshold=None,
+                                      trajectory=None, checkpoint=None, observer=None, crossings=None):
+    if rng is None:
+        rng = np.random.default_rng(random.getrandbits(64))
+
+    stepper = SparseStepper(as_model_spec(model_spec), nucleotide_sequence, rng)
+    distance_by_generation = run_generations(stepper, threshold, trajectory, checkpoint, observer, crossings)
+
+    nucleotide_sequence[:] = decode_sequence(stepper.sequence)
+    return distance_by_generation
+
+
+## The simulation engines the model functions can run on, selected by name
+ENGINES = {
+    "python": simulatate_genetic_evolution,
+    "numpy": simulate_genetic_evolution_numpy,
+    "sparse": simulate_genetic_evolution_sparse,
+}
+
+
+"""
+Function that runs the given compiled model and nucleotide sequence on the named simulation engine, optionally with
+the random number generator to draw from (see make_rng), the genetic distance threshold to stop at, the trajectory
+to record the genetic distances by generation in, the checkpoint to save to and resume from, the observer to report
+progress to, and the dictionary to record the crossing of each of a list of thresholds in
+"""
+def run_engine(engine: str, model_spec, nucleotide_sequence: list, rng=None, threshold=None, trajectory=None,
+               checkpoint=None, observer=None, crossings=None):
+    if engine not in ENGINES:
+        raise ValueError("Unknown simulation engine '" + str(engine) + "', expected one of " + str(list(ENGINES)))
+    return ENGINES[engine](model_spec, nucleotide_sequence, rng, threshold, trajectory, checkpoint, observer,
+                           crossings)
+
+
+"""
+Function that makes the kind of random number generator the named engine draws from, seeded from a numpy SeedSequence:
+a random.Random for the pure Python engine, and a numpy Generator for the others
+"""
+def make_rng(engine: str, seed_sequence: np.random.SeedSequence):
+    if engine == "python":
+        return random.Random(int.from_bytes(seed_sequence.generate_state(4).tobytes(), "little"))
+    return np.random.default_rng(seed_sequence)
+
+
+"""
+Function that returns the mutation rates of the evolutionary models as a dictionary keyed by the names of the user
+defined constants, with any rates given in overrides replacing the constants
+"""
+def model_parameters(overrides: dict = None) -> dict:
+    parameters = {name: globals()[name] for name in PARAMETER_NAMES}
+    if overrides:
+        parameters.update(overrides)
+    return parameters
+
+
+"""
+Function that builds the cumulative mutation table of the Jukes-Cantor Evolutionary model for the
+nucleotide frequencies of a sequence
+"""
+def mutation_table_JC(nucleotide_frequencies: dict, parameters: dict = None) -> dict:
+    ## use the given mutation rates, falling back on the user defined constants above for any that are missing
+    parameters = model_parameters(parameters)
+    JC_alpha = parameters["JC_alpha"]
 
     """
     This mutation table gives all the probabilities of a nucleotide (first key) mutating to the second nucleotide
@@ -191,16 +642,32 @@ def simulate_JC(nucleotide_sequence: list) -> list:
         }
     }
 
+    return mutation_table
 
+
+"""
+Function to simulate the Jukes-Cantor Evolutionary model
+Takes an initial nucleotide sequence, the name of the simulation engine to run on ("python", "numpy" or "sparse"), the
+number of real generations each simulated generation stands for, and optionally the mutation rates to use and a
+trajectory to record the genetic distances by generation in (see trajectory.py), a checkpoint to save to and resume
+from (see checkpoint.py) and an observer to report progress to (see instrumentation.py)
+"""
+def simulate_JC(nucleotide_sequence: list, engine: str = "python", generations_per_step: int = 1,
+                parameters: dict = None, trajectory=None, checkpoint=None, observer=None):
     ## use the generalized simulation function, passing in the JC mutation table and the nucleotide sequence
-    return simulatate_genetic_evolution(mutation_table, nucleotide_sequence)
+    return run_engine(engine, compile_model("JC", nucleotide_sequence, generations_per_step, parameters),
+                      nucleotide_sequence, trajectory=trajectory, checkpoint=checkpoint, observer=observer)
 
 
 """
-Function to simulate the Kimura 2 Parameter Evolutionary model
-Takes an initial nucleotide sequence and a number of generations to simulate
+Function that builds the cumulative mutation table of the Kimura 2 Parameter Evolutionary model for the
+nucleotide frequencies of a sequence
 """
-def simulate_K2P(nucleotide_sequence: list) -> list:
+def mutation_table_K2P(nucleotide_frequencies: dict, parameters: dict = None) -> dict:
+    ## use the given mutation rates, falling back on the user defined constants above for any that are missing
+    parameters = model_parameters(parameters)
+    K2P_alpha = parameters["K2P_alpha"]
+    K2P_beta = parameters["K2P_beta"]
 
     """
     This mutation table gives all the probabilities of a nucleotide (first key) mutating to the second nucleotide
@@ -235,25 +702,39 @@ def simulate_K2P(nucleotide_sequence: list) -> list:
         }
     }
 
-    ## use the generalized simulation function, passing in the K2P mutation table and the nucleotide sequence
-    return simulatate_genetic_evolution(mutation_table, nucleotide_sequence)
+    return mutation_table
 
 
 """
-Function to simulate the HKY85 Evolutionary model
-Takes an initial nucleotide sequence and a number of generations to simulate
+Function to simulate the Kimura 2 Parameter Evolutionary model
+Takes an initial nucleotide sequence, the name of the simulation engine to run on ("python", "numpy" or "sparse"), the
+number of real generations each simulated generation stands for, and optionally the mutation rates to use and a
+trajectory to record the genetic distances by generation in (see trajectory.py), a checkpoint to save to and resume
+from (see checkpoint.py) and an observer to report progress to (see instrumentation.py)
 """
+def simulate_K2P(nucleotide_sequence: list, engine: str = "python", generations_per_step: int = 1,
+                 parameters: dict = None, trajectory=None, checkpoint=None, observer=None):
+    ## use the generalized simulation function, passing in the K2P mutation table and the nucleotide sequence
+    return run_engine(engine, compile_model("K2P", nucleotide_sequence, generations_per_step, parameters),
+                      nucleotide_sequence, trajectory=trajectory, checkpoint=checkpoint, observer=observer)
 
-def simulate_HKY85(nucleotide_sequence: list) -> list:
+
+"""
+Function that builds the cumulative mutation table of the HKY85 Evolutionary model for the
+nucleotide frequencies of a sequence
+"""
+def mutation_table_HKY85(nucleotide_frequencies: dict, parameters: dict = None) -> dict:
+    ## use the given mutation rates, falling back on the user defined constants above for any that are missing
+    parameters = model_parameters(parameters)
+    HKY85_alpha = parameters["HKY85_alpha"]
+    HKY85_beta = parameters["HKY85_beta"]
 
     # calculate the frequency ratios based on the frequency of each nucleotide in the sequence
     # normalize so that an even distribution of nucleotides correlates to 1
-    length = len(nucleotide_sequence)
-
-    pi_A = 4 * (nucleotide_sequence.count('A') / length)
-    pi_C = 4 * (nucleotide_sequence.count('C') / length)
-    pi_G = 4 * (nucleotide_sequence.count('G') / length)
-    pi_T = 4 * (nucleotide_sequence.count('T') / length)
+    pi_A = 4 * nucleotide_frequencies['A']
+    pi_C = 4 * nucleotide_frequencies['C']
+    pi_G = 4 * nucleotide_frequencies['G']
+    pi_T = 4 * nucleotide_frequencies['T']
 
     """
     This mutation table gives all the probabilities of a nucleotide (first key) mutating to the second nucleotide
@@ -288,24 +769,43 @@ def simulate_HKY85(nucleotide_sequence: list) -> list:
         }
     }
 
-    ## use the generalized simulation function, passing in the HKY85 mutation table and the nucleotide sequence
-    return simulatate_genetic_evolution(mutation_table, nucleotide_sequence)
+    return mutation_table
 
 
 """
-Function to simulate the General Time Reversible Evolutionary model
-Takes an initial nucleotide sequence and a number of generations to simulate
+Function to simulate the HKY85 Evolutionary model
+Takes an initial nucleotide sequence, the name of the simulation engine to run on ("python", "numpy" or "sparse"), the
+number of real generations each simulated generation stands for, and optionally the mutation rates to use and a
+trajectory to record the genetic distances by generation in (see trajectory.py), a checkpoint to save to and resume
+from (see checkpoint.py) and an observer to report progress to (see instrumentation.py)
 """
-def simulate_GTR(nucleotide_sequence: list) -> list:
+def simulate_HKY85(nucleotide_sequence: list, engine: str = "python", generations_per_step: int = 1,
+                   parameters: dict = None, trajectory=None, checkpoint=None, observer=None):
+    ## use the generalized simulation function, passing in the HKY85 mutation table and the nucleotide sequence
+    return run_engine(engine, compile_model("HKY85", nucleotide_sequence, generations_per_step, parameters),
+                      nucleotide_sequence, trajectory=trajectory, checkpoint=checkpoint, observer=observer)
 
-    length = len(nucleotide_sequence)
+
+"""
+Function that builds the cumulative mutation table of the General Time Reversible Evolutionary model for the
+nucleotide frequencies of a sequence
+"""
+def mutation_table_GTR(nucleotide_frequencies: dict, parameters: dict = None) -> dict:
+    ## use the given mutation rates, falling back on the user defined constants above for any that are missing
+    parameters = model_parameters(parameters)
+    alpha_AG = parameters["alpha_AG"]
+    alpha_CT = parameters["alpha_CT"]
+    beta_AC = parameters["beta_AC"]
+    beta_AT = parameters["beta_AT"]
+    beta_CG = parameters["beta_CG"]
+    beta_GT = parameters["beta_GT"]
 
     ## calculate the frequency ratios based on the frequency of each nucleotide in the sequence
     ## normalize so that an even distribution of nucleotides correlates to 1
-    pi_A = 4 * (nucleotide_sequence.count('A') / length)
-    pi_C = 4 * (nucleotide_sequence.count('C') / length)
-    pi_G = 4 * (nucleotide_sequence.count('G') / length)
-    pi_T = 4 * (nucleotide_sequence.count('T') / length)
+    pi_A = 4 * nucleotide_frequencies['A']
+    pi_C = 4 * nucleotide_frequencies['C']
+    pi_G = 4 * nucleotide_frequencies['G']
+    pi_T = 4 * nucleotide_frequencies['T']
 
     """
     This mutation table gives all the probabilities of a nucleotide (first key) mutating to the second nucleotide
@@ -340,5 +840,198 @@ def simulate_GTR(nucleotide_sequence: list) -> list:
         }
     }
 
+    return mutation_table
+
+
+"""
+Function to simulate the General Time Reversible Evolutionary model
+Takes an initial nucleotide sequence, the name of the simulation engine to run on ("python", "numpy" or "sparse"), the
+number of real generations each simulated generation stands for, and optionally the mutation rates to use and a
+trajectory to record the genetic distances by generation in (see trajectory.py), a checkpoint to save to and resume
+from (see checkpoint.py) and an observer to report progress to (see instrumentation.py)
+"""
+def simulate_GTR(nucleotide_sequence: list, engine: str = "python", generations_per_step: int = 1,
+                 parameters: dict = None, trajectory=None, checkpoint=None, observer=None):
     ## use the generalized simulation function, passing in the GTR mutation table and the nucleotide sequence
-    return simulatate_genetic_evolution(mutation_table, nucleotide_sequence)
+    return run_engine(engine, compile_model("GTR", nucleotide_sequence, generations_per_step, parameters),
+                      nucleotide_sequence, trajectory=trajectory, checkpoint=checkpoint, observer=observer)
+
+
+## The evolutionary models in the study, and the functions that build their mutation tables, by name
+MODELS = ["JC", "K2P", "HKY85", "GTR"]
+MUTATION_TABLES = {
+    "JC": mutation_table_JC,
+    "K2P": mutation_table_K2P,
+    "HKY85": mutation_table_HKY85,
+    "GTR": mutation_table_GTR,
+}
+
+## Compiled models already built, keyed by model, generations per step, mutation rates and nucleotide frequencies
+compiled_models = {}
+
+
+"""
+Function that builds the rate matrix Q of a mutation table, where Q[i][j] is the rate nucleotide i mutates to nucleotide j
+per generation, and each diagonal entry is minus the total rate the nucleotide mutates away
+"""
+def rate_matrix(mutation_table: dict) -> np.ndarray:
+    return mutation_table_to_probabilities(mutation_table) - np.identity(len(NUCLEOTIDES))
+
+
+"""
+Function to calculate the matrix exponential exp(matrix) by scaling the matrix down until a Taylor series converges
+quickly, then squaring the result back up
+"""
+def matrix_exponential(matrix: np.ndarray) -> np.ndarray:
+    norm = np.abs(matrix).sum(axis=1).max()
+    squarings = max(0, int(np.ceil(np.log2(norm))) + 1) if norm > 0 else 0
+    scaled_matrix = matrix / (2 ** squarings)
+
+    result = np.identity(len(matrix))
+    term = np.identity(len(matrix))
+    for n in range(1, 20):
+        term = term @ scaled_matrix / n
+        result = result + term
+
+    for _ in range(squarings):
+        result = result @ result
+    return result
+
+
+"""
+Function that turns a one generation mutation table into the mutation table for a leap of k generations, by building
+the rate matrix Q and taking P(k) = exp(Qk). For mutation rates as small as real per generation rates this is the same
+as mutating k times in a row, so one simulated generation can stand for k real generations without inflating the rates
+by hand. The result is returned in the same cumulative form as the one generation tables, so every engine can use it.
+"""
+def leap_mutation_table(mutation_table: dict, generations_per_step: int) -> dict:
+    probabilities = matrix_exponential(rate_matrix(mutation_table) * generations_per_step)
+    ## rounding can leave tiny negative probabilities, and the last cumulative probability must be exactly 1
+    cumulative = np.cumsum(np.clip(probabilities, 0.0, None), axis=1)
+    cumulative = cumulative / cumulative[:, -1:]
+    return {source: {target: float(cumulative[i][j]) if j < len(NUCLEOTIDES) - 1 else 1
+                     for j, target in enumerate(NUCLEOTIDES)}
+            for i, source in enumerate(NUCLEOTIDES)}
+
+
+"""
+Function that compiles the named model for a nucleotide sequence, where each simulated generation stands for
+generations_per_step real generations. Compiled models are cached by model, generations per step, mutation rates and
+nucleotide frequencies, so every replicate of the same gene shares one set of tables (and leap tables only pay for the
+matrix exponential once).
+"""
+def compile_model(model: str, nucleotide_sequence: list, generations_per_step: int = 1,
+                  parameters: dict = None) -> ModelSpec:
+    nucleotide_frequencies = calculate_nucleotide_frequencies(nucleotide_sequence)
+    parameters = model_parameters(parameters)
+    key = (model, generations_per_step, tuple(sorted(parameters.items())), tuple(nucleotide_frequencies.values()))
+
+    if key not in compiled_models:
+        mutation_table = MUTATION_TABLES[model](nucleotide_frequencies, parameters)
+        if generations_per_step != 1:
+            validate_cumulative_table(mutation_table_to_array(mutation_table), model)
+            mutation_table = leap_mutation_table(mutation_table, generations_per_step)
+        compiled_models[key] = ModelSpec(model, mutation_table)
+    return compiled_models[key]
+
+
+"""
+Function that returns a compiled model as is, or compiles a plain cumulative mutation table into one
+"""
+def as_model_spec(model_spec) -> ModelSpec:
+    if isinstance(model_spec, ModelSpec):
+        return model_spec
+    return ModelSpec("custom", model_spec)
+
+
+"""
+Function to simulate many replicates of one or more evolutionary models at once. Every replicate of every model is a row
+of one replicates x sites array of nucleotide codes, and all rows are mutated together one generation at a time using
+the alias tables of each row's compiled model. Once the consensus generations of a replicate average at or above the genetic
+distance threshold, that replicate is retired from the array and the rest carry on.
+
+Returns two dictionaries keyed by model name, the first holding the list of genetic distances by generation of each
+replicate, and the second holding the number of generations each replicate took (the same shape as
+generations_by_model in the main program)
+"""
+def simulate_batch(nucleotide_sequence: list, models: list = MODELS, n_replicates: int = 20, rng=None,
+                   generations_per_step: int = 1, parameters: dict = None, threshold: float = None) -> tuple:
+    if rng is None:
+        rng = np.random.default_rng(random.getrandbits(64))
+    if threshold is None:
+        threshold = threshold_genetic_distance
+
+    original_sequence = encode_sequence(nucleotide_sequence)
+    length = len(original_sequence)
+
+    ## one set of alias tables per model, and the model each row of the batch is running
+    model_specs = [compile_model(model, nucleotide_sequence, generations_per_step, parameters) for model in models]
+    alias_probabilities = np.stack([model_spec.alias_probabilities for model_spec in model_specs])
+    alias_nucleotides = np.stack([model_spec.alias_nucleotides for model_spec in model_specs])
+    row_models = np.repeat(np.arange(len(models)), n_replicates)
+    rows = len(row_models)
+
+    sequences = np.tile(original_sequence, (rows, 1))
+    ## the number of sites of each row that differ from the original sequence, kept up to date at the changed sites
+    differences = np.zeros(rows, dtype=np.int64)
+    ## ring of the difference counts of the last n consensus generations of each row, with a running total per row
+    recent_differences = np.zeros((rows, consensus_generations), dtype=np.int64)
+    window_totals = np.zeros(rows, dtype=np.int64)
+    ## which replicate each row of the (shrinking) batch belongs to
+    active_rows = np.arange(rows)
+    distances = [[0.0] for _ in range(rows)]
+    generation = 1
+
+    while active_rows.size > 0:
+        ## sample every site from its nucleotide's alias table: the whole part of 4 x the random number picks the
+        ## column, and the fractional part decides between the column and its alias
+        random_floats = rng.random(sequences.shape) * len(NUCLEOTIDES)
+        columns = random_floats.astype(np.uint8)
+        batch_models = row_models[active_rows][:, None]
+        keep_column = (random_floats - columns) < alias_probabilities[batch_models, sequences, columns]
+        mutated = np.where(keep_column, columns, alias_nucleotides[batch_models, sequences, columns])
+
+        changed_rows, changed_sites = np.nonzero(mutated != sequences)
+        original_nucleotides = original_sequence[changed_sites]
+        change = (mutated[changed_rows, changed_sites] != original_nucleotides).astype(np.int64) - \
+            (sequences[changed_rows, changed_sites] != original_nucleotides)
+        differences += np.bincount(changed_rows, weights=change, minlength=len(active_rows)).astype(np.int64)
+        sequences = mutated
+
+        for row, row_differences in zip(active_rows.tolist(), differences.tolist()):
+            distances[row].append(row_differences / length)
+
+        position = generation % consensus_generations
+        window_totals += differences - recent_differences[:, position]
+        recent_differences[:, position] = differences
+        generation += 1
+        window = min(generation, consensus_generations)
+
+        ## retire every row whose consensus generations reached the threshold
+        still_running = window_totals / (window * length) < threshold
+        if not still_running.all():
+            active_rows = active_rows[still_running]
+            sequences = sequences[still_running]
+            differences = differences[still_running]
+            recent_differences = recent_differences[still_running]
+            window_totals = window_totals[still_running]
+
+    distances_by_model = {}
+    generations_by_model = {}
+    for model_index, model in enumerate(models):
+        model_distances = distances[model_index * n_replicates:(model_index + 1) * n_replicates]
+        distances_by_model[model] = model_distances
+        generations_by_model[model] = [len(distance_by_generation) for distance_by_generation in model_distances]
+
+    return distances_by_model, generations_by_model
+
+
+"""
+Function to simulate a number of replicates of a single evolutionary model as one batch, returning the list of genetic
+distances by generation of each replicate
+"""
+def simulate_replicates(model: str, nucleotide_sequence: list, n_replicates: int, rng=None,
+                        generations_per_step: int = 1, parameters: dict = None, threshold: float = None) -> list:
+    distances_by_model, generations_by_model = simulate_batch(nucleotide_sequence, [model], n_replicates, rng,
+                                                              generations_per_step, parameters, threshold)
+    return distances_by_model[model]
@@ -0,0 +1,122 @@
+"""
+This file provides observers that watch a simulation while it runs, instead of it being a black box until it returns.
+
+An observer is given to any of the simulation engines (or simulate_* model functions), which hand it to the generation
+loop (run_generations in evolutionary_models.py). The loop shows it the stepper and the consensus window when the
+simulation starts, every observer.every generations, and when it finishes. Without an observer the loop only checks
+that there is none, so a simulation that is not being watched runs at full speed, and a watched one only pays for the
+generations it is sampled at.
+
+RunObserver is the interface, doing nothing at each point. ProgressCounters samples the built in counters: the time
+taken, the generations per second, the mutations applied per generation, the current genetic distance, and how close
+the consensus generations are to the genetic distance threshold. It can pass each sample to a callback (e.g.
+print_progress) and export the whole profile of the run to a csv or JSON file.
+"""
+
+import csv
+import json
+import time
+
+
+"""
+The interface of an observer of the generation loop, which does nothing. Subclasses override the points they need.
+"""
+class RunObserver:
+    def __init__(self, every: int = 1000):
+        if every < 1:
+            raise ValueError("An observer must be sampled every 1 or more generations")
+        self.every = every
+
+    ## called once before the first generation is mutated (or after resuming from a checkpoint)
+    def start(self, generation: int, stepper, window):
+        pass
+
+    ## called every self.every generations
+    def sample(self, generation: int, stepper, window):
+        pass
+
+    ## called once the consensus generations have reached the genetic distance threshold
+    def finish(self, generation: int, stepper, window):
+        pass
+
+
+"""
+Observer that records a profile of the run from the built in counters every so many generations. Each sample is a
+dictionary of the generation, the seconds since the start, the generations per second and mutations per generation
+since the previous sample, the total mutations applied, the current genetic distance, the average distance of the
+consensus generations, and that average as a fraction of the genetic distance threshold. The callback, if given, is
+called with every sample as it is taken.
+"""
+class ProgressCounters(RunObserver):
+    def __init__(self, every: int = 1000, callback=None):
+        super().__init__(every)
+        self.callback = callback
+        self.samples = []
+        self.start_time = None
+        self.previous_time = None
+        self.previous_generation = 0
+        self.previous_mutations = 0
+
+    def start(self, generation: int, stepper, window):
+        self.start_time = self.previous_time = time.perf_counter()
+        self.previous_generation = generation
+        self.previous_mutations = stepper.mutations
+        self.record(generation, stepper, window)
+
+    def sample(self, generation: int, stepper, window):
+        self.record(generation, stepper, window)
+
+    def finish(self, generation: int, stepper, window):
+        if not self.samples or self.samples[-1]["generation"] != generation:
+            self.record(generation, stepper, window)
+
+    def record(self, generation: int, stepper, window):
+        now = time.perf_counter()
+        generations = generation - self.previous_generation
+        seconds = now - self.previous_time
+        consensus_distance = window.average_distance()
+
+        sample = {
+            "generation": generation,
+            "seconds": now - self.start_time,
+            "generations_per_second": generations / seconds if generations > 0 and seconds > 0 else 0.0,
+            "mutations_per_generation": (stepper.mutations - self.previous_mutations) / generations
+                                        if generations > 0 else 0.0,
+            "mutations": stepper.mutations,
+            "distance": stepper.differences / stepper.length,
+            "consensus_distance": consensus_distance,
+            "threshold_fraction": consensus_distance / window.threshold,
+        }
+        self.samples.append(sample)
+        self.previous_time = now
+        self.previous_generation = generation
+        self.previous_mutations = stepper.mutations
+
+        if self.callback is not None:
+            self.callback(sample)
+
+    """
+    Writes the profile of the run to a file, as a csv file with one row per sample, or as a JSON list of the samples if
+    the file name ends in .json
+    """
+    def export(self, file_name: str):
+        if file_name.endswith(".json"):
+            with open(file_name, 'w') as file:
+                json.dump(self.samples, file, indent=1)
+            return
+
+        with open(file_name, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=["generation", "seconds", "generations_per_second",
+                                                      "mutations_per_generation", "mutations", "distance",
+                                                      "consensus_distance", "threshold_fraction"])
+            writer.writeheader()
+            writer.writerows(self.samples)
+
+
+"""
+Callback for ProgressCounters that prints a one line summary of each sample
+"""
+def print_progress(sample: dict):
+    print("generation", sample["generation"], "|", round(sample["generations_per_second"], 1), "generations/s |",
+          round(sample["mutations_per_generation"], 2), "mutations/generation | distance",
+          round(sample["distance"], 4), "|", str(round(100 * sample["threshold_fraction"], 1)) + "% of threshold")
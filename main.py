@@ -8,7 +8,7 @@ each simulation for each model.
 
 IMPORTANT: you must set the model parameters (mutation rates for transitions, transversions, etc.) in the
 evolutionary_models.py file! These values are formatted and found in the mutation rates txt file labeled by the name of
-the gene.
+the gene. (Without interaction, the mutation rates txt file of each sequence file can be given with --rates instead.)
 
 Once the file has been given by the user, the program will run a simulation for each model 20 times, each time producing
 a scatter plot showing the genetic distance as a function of generation, or normalized generation, and the number of
@@ -22,15 +22,45 @@ models for that particular gene.
 
 Please make sure that you have all the required packages available on you computer when running the program.
 I used Spyder3 IDE, as it made it easy to produce the graphs right within the IDE as the program was running. 
+
+The program can also be run without any user interaction (e.g. under a job scheduler) by giving it the sequence files on
+the command line. Every record of every file (e.g. a FASTA file of many genes) is simulated, with the replicates of each
+model of all of them scheduled across one pool of worker processes. It writes a results txt file for each record to the
+output directory, and only imports matplotlib (with a backend that does not need a display) and saves the plots there
+when --plots is given. With --checkpoint-dir, every simulation saves checkpoints as it runs, and running the same
+command again after it was stopped (e.g. on a preempted node) resumes the unfinished simulations. With --store, every
+replicate is saved to a SQLite results store and served from it when the same simulation is asked for again, so e.g.
+redrawing the plots does not simulate anything (the distances are only stored when every generation of them was kept).
+The distances of each replicate are recorded in a compact Trajectory (see trajectory.py) while they are kept for the
+plots, and --plot-stride keeps only every so many generations of them (or, with --plot-decimation minmax, the smallest
+and largest distance of every so many) for very long simulations. The mean, standard deviation and 95% confidence
+interval of each model are printed with the results. With --precision, the number of replicates is not fixed: each model
+of each record keeps getting more replicates (between --min-replicates and --max-replicates) only until the 95%
+confidence interval of its mean number of generations is within that fraction of the mean. With --rates, the records of
+each sequence file are simulated with the mutation rates of the matching mutation rates txt file (one per sequence file,
+in the same order); without it, every record uses the constants in evolutionary_models.py. For example:
+
+    python main.py HIV_gag_sequence.txt drosophila_white_sequence.txt --rates hiv_gag_mutation_rates.txt
+        drosophila_white_mutation_rates.txt --models JC K2P --replicates 20 --output-dir results
+    python main.py HIV_gag_sequence.txt --precision 0.05 --min-replicates 5 --max-replicates 100
 """
+import argparse
+import os
+
 from validate_input import *
 from evolutionary_models import *
-from plot import *
+
+## The number of real generations each simulated generation stands for. Leave this at 1 when the mutation rates in
+## evolutionary_models.py are per generation rates that are large enough to simulate directly, or set it to the time
+## resolution wanted (e.g. 100000) to run a slow gene with its real per generation rates
+generations_per_step = 1
 
 def main():
     """
     This is the main function of the program.
     """
+    ## matplotlib is only imported once plotting is actually needed
+    from plot import plot_data, plot_all_data
 
     ## Get the nucleotide sequence
     nucleotide_sequence = validate_input()
@@ -54,31 +84,31 @@ def main():
 
     for i in range(20):
         ## Get the list of genetic distances by generation of each generation using the Jukes-Cantor Evolutionary model
-        JC_distance = simulate_JC(nucleotide_sequence.copy())
+        JC_distance = simulate_JC(nucleotide_sequence.copy(), generations_per_step=generations_per_step)
         plot_data(JC_distance, "Jukes-Cantor simulation for HIV Gag (" +
-                  str(len(JC_distance)) + " generations)", "blue", 1)
+                  str(len(JC_distance)) + " generations)", "blue", generations_per_step)
 
         # Get the list of genetic distances by generation of each generation using the Kimura 2 Parameter Evolutionary model
-        K2P_distance = simulate_K2P(nucleotide_sequence.copy())
+        K2P_distance = simulate_K2P(nucleotide_sequence.copy(), generations_per_step=generations_per_step)
         # Plot the data
         plot_data(K2P_distance, "K2P simulation for HIV Gag (" +
-                  str(len(K2P_distance)) + " generations)", "green", 1)
+                  str(len(K2P_distance)) + " generations)", "green", generations_per_step)
 
         # Get the list of genetic distances by generation of each generation using the HKY85 Evolutionary model
-        HKY85_distance = simulate_HKY85(nucleotide_sequence.copy())
+        HKY85_distance = simulate_HKY85(nucleotide_sequence.copy(), generations_per_step=generations_per_step)
         # Plot the data
         plot_data(HKY85_distance, "HKY85 simulation for HIV Gag (" +
-                  str(len(HKY85_distance)) + " generations)", "red", 1)
+                  str(len(HKY85_distance)) + " generations)", "red", generations_per_step)
 
         # Get the list of genetic distances by generation of each generation using the General Time Reversible Evolutionary model
-        GTR_distance = simulate_GTR(nucleotide_sequence.copy())
+        GTR_distance = simulate_GTR(nucleotide_sequence.copy(), generations_per_step=generations_per_step)
         # Plot the data
         plot_data(GTR_distance, "GTR simulation for HIV Gag (" +
-                str(len(GTR_distance)) + " generations)", "orange", 10000000)
+                str(len(GTR_distance)) + " generations)", "orange", generations_per_step)
 
         ## Create the overlay plot for each of the models for this simulation
         plot_all_data(JC_distance, K2P_distance, HKY85_distance, GTR_distance,
-                      "Overlay of evolutionary model simulations", 1)
+                      "Overlay of evolutionary model simulations", generations_per_step)
 
         ## append the number of generations to reach the genetic distance threshold for each model for this simulation
         ## to the corresponding list
@@ -91,4 +121,140 @@ def main():
     generations_by_model = {"JC":JC_generation_lengths, "K2P":K2P_generation_lengths, "HKY85":HKY85_generation_lengths, "GTR":GTR_generation_lengths}
     print("Number of generations for each simulation by model: ", "\n", generations_by_model)
 
-main()
+
+## the plot titles of the models
+MODEL_TITLES = {"JC": "Jukes-Cantor", "K2P": "K2P", "HKY85": "HKY85", "GTR": "GTR"}
+
+
+"""
+Function that writes the nucleotide distribution of a gene and the number of generations each simulation took by
+model to a results txt file, in the same layout as the results files of the study
+"""
+def write_results(file_name: str, nucleotide_distribution: dict, generations_by_model: dict):
+    with open(file_name, 'w') as file:
+        file.write("Nucleotide distribution:  " + str(nucleotide_distribution) + "\n\n")
+        file.write(" Number of generations for each simulation by model:\n " + str(generations_by_model) + "\n")
+
+
+"""
+Function that runs every record of the sequence files without any user interaction: the replicates of each model of
+every record are scheduled across one shared pool of worker processes (longest expected first), the results of each
+record are written to a results txt file named after it in the output directory, and the plots are saved there too if
+they are wanted (rendered by the worker processes). The simulations are checkpointed to the checkpoint directory if one
+is given, and the replicates are read from and saved to the results store at store_path if one is given. Given a
+precision, n_replicates is ignored and each model gets between min_replicates and max_replicates replicates (see
+run_sequences_adaptive in scheduler.py). Given a mutation rates txt file for each sequence file, the records of each
+file are simulated with its rates instead of the constants in evolutionary_models.py. The plots keep every
+plot_stride-th generation of each replicate (see Trajectory for the plot_decimation).
+"""
+def run_batch(sequence_files: list, models: list, n_replicates: int, output_directory: str, engine: str = "numpy",
+              workers: int = None, master_seed: int = 0, generations_per_step: int = 1, plots: bool = False,
+              checkpoint_directory: str = None, store_path: str = None, precision: float = None,
+              min_replicates: int = 5, max_replicates: int = 100, rate_files: list = None, plot_stride: int = 1,
+              plot_decimation: str = "stride"):
+    from results_store import ResultsStore, print_summary, summarize_generations
+    from scheduler import load_sequence_records, run_sequences, run_sequences_adaptive
+
+    if rate_files is not None and len(rate_files) != len(sequence_files):
+        raise ValueError("Expected a mutation rates file for each of the " + str(len(sequence_files)) +
+                         " sequence files, not " + str(len(rate_files)))
+
+    os.makedirs(output_directory, exist_ok=True)
+    if checkpoint_directory is not None:
+        os.makedirs(checkpoint_directory, exist_ok=True)
+    if plots:
+        ## use a backend that writes files without needing a display, before pyplot is imported
+        import matplotlib
+        matplotlib.use("Agg")
+        from plot import MODEL_COLORS, plot_data, plot_overlay, render_figures
+
+    ## the files are read one at a time so one that cannot be read is skipped, sharing the names taken so far so two
+    ## records never get the same results files
+    records = []
+    names = set()
+    for number, sequence_file in enumerate(sequence_files):
+        try:
+            parameters = read_mutation_rates(rate_files[number]) if rate_files is not None else None
+            records += load_sequence_records([sequence_file], names, parameters)
+        except (OSError, ValueError) as error:
+            print("Skipping", sequence_file, "-", error)
+
+    ## the distances are only kept for the plots, thinned out to the stride and decimation of their trajectories
+    keep_distances = (plot_stride, plot_decimation) if plots else False
+    store = ResultsStore(store_path) if store_path is not None else None
+    if precision is not None:
+        results = run_sequences_adaptive(records, models, precision, min_replicates, max_replicates, workers,
+                                         master_seed, engine, generations_per_step, keep_distances=keep_distances,
+                                         checkpoint_directory=checkpoint_directory, store=store)
+    else:
+        results = run_sequences(records, models, n_replicates, workers, master_seed, engine, generations_per_step,
+                                keep_distances=keep_distances, checkpoint_directory=checkpoint_directory,
+                                store=store)
+    if store is not None:
+        store.close()
+
+    figures = []
+    for record in records:
+        distances_by_model, generations_by_model = results[record.name]
+        write_results(os.path.join(output_directory, record.name + "_results.txt"),
+                      calculate_nucleotide_frequencies(record.nucleotide_sequence), generations_by_model)
+        print(record.title, "number of generations for each simulation by model: ", "\n", generations_by_model)
+        print_summary(summarize_generations(generations_by_model))
+
+        if not plots:
+            continue
+        ## with adaptive replicates the models can have different numbers of replicates
+        for replicate in range(max(len(generations_by_model[model]) for model in models)):
+            replicate_models = [model for model in models if replicate < len(generations_by_model[model])]
+            for model in replicate_models:
+                distance_by_generation = distances_by_model[model][replicate]
+                figures.append((plot_data, (
+                    distance_by_generation, MODEL_TITLES[model] + " simulation for " + record.title + " (" +
+                    str(len(distance_by_generation)) + " generations)", MODEL_COLORS[model], generations_per_step,
+                    os.path.join(output_directory, record.name + "_" + model + "_" + str(replicate) + ".png"))))
+            figures.append((plot_overlay, (
+                {model: distances_by_model[model][replicate] for model in replicate_models},
+                "Overlay of evolutionary model simulations for " + record.title, generations_per_step,
+                os.path.join(output_directory, record.name + "_overlay_" + str(replicate) + ".png"))))
+    if figures:
+        render_figures(figures, workers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate the evolutionary models until they reach maximum genetic "
+                                                 "distance. Without any sequence files the program asks for one and "
+                                                 "shows its plots interactively.")
+    parser.add_argument("sequence_files", nargs="*",
+                        help="sequence txt (FASTA) files to simulate every record of without interaction")
+    parser.add_argument("--models", nargs="+", choices=MODELS, default=MODELS)
+    parser.add_argument("--replicates", type=int, default=20)
+    parser.add_argument("--output-dir", default="results")
+    parser.add_argument("--engine", choices=list(ENGINES), default="numpy")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--seed", type=int, default=0, help="master seed the replicate seeds are derived from")
+    parser.add_argument("--generations-per-step", type=int, default=generations_per_step)
+    parser.add_argument("--plots", action="store_true", help="save the plots to the output directory")
+    parser.add_argument("--plot-stride", type=int, default=1,
+                        help="keep the genetic distance of only every this many generations for the plots")
+    parser.add_argument("--plot-decimation", choices=["stride", "minmax"], default="stride",
+                        help="keep every stride-th distance, or the smallest and largest of every stride generations")
+    parser.add_argument("--checkpoint-dir", default=None,
+                        help="save checkpoints of the simulations here, and resume from them when run again")
+    parser.add_argument("--store", default=None,
+                        help="SQLite results store to save the replicates to and serve repeated ones from")
+    parser.add_argument("--precision", type=float, default=None,
+                        help="run replicates until the 95%% confidence interval of each model's mean number of "
+                             "generations is within this fraction of the mean (e.g. 0.05), instead of --replicates")
+    parser.add_argument("--min-replicates", type=int, default=5)
+    parser.add_argument("--max-replicates", type=int, default=100)
+    parser.add_argument("--rates", nargs="+", default=None,
+                        help="mutation rates txt file of each sequence file, in the same order")
+    arguments = parser.parse_args()
+
+    if arguments.sequence_files:
+        run_batch(arguments.sequence_files, arguments.models, arguments.replicates, arguments.output_dir,
+                  arguments.engine, arguments.workers, arguments.seed, arguments.generations_per_step, arguments.plots,
+                  arguments.checkpoint_dir, arguments.store, arguments.precision, arguments.min_replicates,
+                  arguments.max_replicates, arguments.rates, arguments.plot_stride, arguments.plot_decimation)
+    else:
+        main()
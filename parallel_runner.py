@@ -0,0 +1,182 @@
+"""
+This file runs the replicate simulations of the evolutionary models across a pool of worker processes instead of one
+after another.
+
+Every simulation (one replicate of one model) is an independent task. Each task gets its own random number generator
+seeded from a single master seed together with the model and the replicate number, so a task draws the same random
+numbers no matter which worker runs it or how many workers there are. Running again with the same master seed gives
+exactly the same results on any number of cores. When one batch simulates several sequences (or one sequence under
+several sets of mutation rates), each of them is also given its own seed stream number (see seed_stream), so replicate
+k of a model for one sequence does not draw the same random numbers as replicate k for another, and the results of
+different sequences are independent. Stream 0, the default, gives the seeds of a run of a single sequence.
+
+Given a checkpoint directory, every task saves checkpoints of its simulation there (see checkpoint.py), named after the
+task, so running the same tasks again after the batch was stopped resumes each unfinished simulation where it was.
+"""
+
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from checkpoint import Checkpoint
+from evolutionary_models import MODELS, compile_model, make_rng, run_engine
+from predictor import presized_trajectory
+
+
+"""
+Function that builds the independent seed stream of one replicate of one model from the master seed, and the stream
+number of the sequence it simulates when a batch simulates several (0 adds nothing, keeping the seeds of a single run)
+"""
+def replicate_seed(master_seed: int, model: str, replicate: int, stream: int = 0) -> np.random.SeedSequence:
+    spawn_key = (MODELS.index(model), replicate) + ((stream,) if stream else ())
+    return np.random.SeedSequence(master_seed, spawn_key=spawn_key)
+
+
+"""
+Function that makes the seed stream number of one of the sequences of a batch from labels that tell it apart from the
+others (e.g. its unique record name, or its gene and rate scale), the same every time for the same labels
+"""
+def seed_stream(*labels) -> int:
+    return int.from_bytes(hashlib.sha256(repr(labels).encode("utf-8")).digest()[:4], "little")
+
+
+"""
+Function that returns the stride and decimation of the Trajectory (see trajectory.py) the genetic distances of a task
+are kept in, from its keep_distances: True keeps every generation, and a (stride, decimation) pair thins them out
+"""
+def distance_storage(keep_distances) -> tuple:
+    if keep_distances is True:
+        return 1, "stride"
+    stride, decimation = keep_distances
+    return stride, decimation
+
+
+"""
+Function that names the checkpoint file of a task after everything that decides its results (and how its distances
+are kept, which decides what the checkpoint holds), so a checkpoint is only ever resumed by the same simulation
+"""
+def checkpoint_path(task: tuple) -> str:
+    model, replicate = task[:2]
+    checkpoint_directory = task[-1]
+    digest = hashlib.sha256(repr(task[2:-1]).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(checkpoint_directory, model + "_" + str(replicate) + "_" + digest + ".npz")
+
+
+"""
+Function that runs a single replicate simulation in a worker process. The task holds the model, the replicate number,
+the nucleotide sequence as a string, and the settings of the run (see replicate_tasks).
+Returns the model, the replicate number and the genetic distances by generation, recorded in a Trajectory presized to
+the expected length of the run (see predictor.py) and sent back as its kept points (a TrajectoryPoints, whose len() is
+the number of generations), or only the number of generations when the distances are not being kept. When the
+threshold is a list of thresholds, the last is instead a dictionary of the number of generations it took to reach each
+of them.
+"""
+def run_replicate(task: tuple) -> tuple:
+    (model, replicate, sequence, engine, generations_per_step, parameters, threshold, master_seed, stream,
+     keep_distances, checkpoint_directory) = task
+
+    nucleotide_sequence = list(sequence)
+    model_spec = compile_model(model, nucleotide_sequence, generations_per_step, parameters)
+    rng = make_rng(engine, replicate_seed(master_seed, model, replicate, stream))
+    checkpoint = Checkpoint(checkpoint_path(task)) if checkpoint_directory is not None else None
+    crossings = {}
+    trajectory = None
+    if keep_distances and not isinstance(threshold, (list, tuple)):
+        stride, decimation = distance_storage(keep_distances)
+        trajectory = presized_trajectory(model, nucleotide_sequence, generations_per_step, parameters, threshold,
+                                         stride, decimation)
+    distance_by_generation = run_engine(engine, model_spec, nucleotide_sequence, rng, threshold, trajectory,
+                                        checkpoint=checkpoint, crossings=crossings)
+
+    if isinstance(threshold, (list, tuple)):
+        return model, replicate, crossings
+    if trajectory is not None:
+        trajectory.close()
+        return model, replicate, trajectory.compact()
+    return model, replicate, len(distance_by_generation)
+
+
+"""
+Function that builds the list of tasks for n replicates of each model for a nucleotide sequence, drawing from the given
+seed stream (see seed_stream) when it is one of several sequences of a batch. keep_distances is False to only count the
+generations, True to keep the genetic distance of every generation, or a (stride, decimation) pair for the Trajectory
+to keep them in (e.g. (100, "minmax") for the smallest and largest distance of every 100 generations).
+"""
+def replicate_tasks(nucleotide_sequence: list, models: list = MODELS, n_replicates: int = 20, master_seed: int = 0,
+                    engine: str = "numpy", generations_per_step: int = 1, parameters: dict = None,
+                    threshold: float = None, keep_distances=True, checkpoint_directory: str = None,
+                    stream: int = 0) -> list:
+    sequence = "".join(nucleotide_sequence)
+    return [(model, replicate, sequence, engine, generations_per_step, parameters, threshold, master_seed, stream,
+             keep_distances, checkpoint_directory)
+            for model in models for replicate in range(n_replicates)]
+
+
+"""
+Function that runs a list of replicate tasks across the given number of worker processes (all the cores of the
+machine when workers is None, and no extra processes at all when workers is 1), returning their results in task order.
+The tasks are sent to the workers in chunks, unless a chunk size is given (1 keeps the workers taking the tasks in
+exactly the order given).
+"""
+def run_tasks(tasks: list, workers: int = None, chunksize: int = None) -> list:
+    if workers == 1:
+        return [run_replicate(task) for task in tasks]
+
+    if chunksize is None:
+        ## about 4 chunks per worker, the workers being the cores of the machine by default as for the executor
+        chunksize = max(1, len(tasks) // (4 * (workers or os.cpu_count() or 1)))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run_replicate, tasks, chunksize=chunksize))
+
+
+"""
+Function to run n replicates of each model for a nucleotide sequence, spread across the given number of worker
+processes.
+
+Returns two dictionaries keyed by model name, the first holding the genetic distances by generation of each replicate
+as TrajectoryPoints (empty when keep_distances is False, see replicate_tasks), and the second holding the number of
+generations each replicate took, in replicate order (the same shape as generations_by_model in the main program). When
+the threshold is a list of thresholds, each replicate's number of generations is a dictionary keyed by threshold (see
+split_crossings).
+"""
+def run_replicates(nucleotide_sequence: list, models: list = MODELS, n_replicates: int = 20, workers: int = None,
+                   master_seed: int = 0, engine: str = "numpy", generations_per_step: int = 1,
+                   parameters: dict = None, threshold: float = None, keep_distances=True,
+                   checkpoint_directory: str = None) -> tuple:
+    tasks = replicate_tasks(nucleotide_sequence, models, n_replicates, master_seed, engine, generations_per_step,
+                            parameters, threshold, keep_distances, checkpoint_directory)
+    return gather_results(run_tasks(tasks, workers), models, n_replicates, keep_distances)
+
+
+"""
+Function that collects the results of the replicate tasks into dictionaries of distances and generations by model
+"""
+def gather_results(results, models: list, n_replicates: int, keep_distances) -> tuple:
+    distances_by_model = {model: [None] * n_replicates for model in models} if keep_distances else {}
+    generations_by_model = {model: [0] * n_replicates for model in models}
+
+    for model, replicate, result in results:
+        if isinstance(result, dict):
+            generations_by_model[model][replicate] = result
+        elif keep_distances:
+            distances_by_model[model][replicate] = result
+            generations_by_model[model][replicate] = len(result)
+        else:
+            generations_by_model[model][replicate] = result
+
+    return distances_by_model, generations_by_model
+
+
+"""
+Function that splits the generations_by_model of a run with a list of thresholds, where each replicate has a
+dictionary of the number of generations it took to reach each threshold, into a generations_by_model for each threshold
+"""
+def split_crossings(generations_by_model: dict) -> dict:
+    by_threshold = {}
+    for model, replicates in generations_by_model.items():
+        for crossings in replicates:
+            for threshold, generations in crossings.items():
+                by_threshold.setdefault(threshold, {}).setdefault(model, []).append(generations)
+    return dict(sorted(by_threshold.items()))
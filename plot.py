@@ -1,59 +1,168 @@
 """
 This file provides the different functions for plotting the distances by generation for the different evolutionary
-model simulations
+model simulations. Each plot is shown on screen, or saved to a file instead when an output path is given.
+
+Long simulations can have millions of generations, far more than there are pixels across a graph. Before drawing, the
+points of a trajectory are binned to the width of the figure in pixels, keeping the smallest and largest genetic
+distance of each bin (so the spread of the trajectory looks the same), and any series that is still dense is
+rasterized so saved figures stay small. Many figures can also be rendered at once by a pool of worker processes.
 """
 
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 from matplotlib import pyplot as plt
 import math
 
+## the colors of the models on the graphs
+MODEL_COLORS = {"JC": "blue", "K2P": "green", "HKY85": "red", "GTR": "orange"}
+
+## series with more points than this are drawn rasterized instead of as one vector marker per point
+RASTERIZE_POINTS = 1000
+
 """
-Function for plotting a single scatter plot of the genetic distance by generation
+Function that returns the generations and genetic distances to plot for a list of genetic distances by generation, or
+for a Trajectory that may only have kept some of the generations
+"""
+def trajectory_points(distance_by_generation):
+    if hasattr(distance_by_generation, "points"):
+        return distance_by_generation.points()
+    return np.arange(len(distance_by_generation)), np.array(distance_by_generation)
+
+
+"""
+The points of a trajectory that have already been binned, so they can be sent to a worker process cheaply and plotted
+like any other trajectory
 """
-def plot_data(distance_by_generation, graph_title, color, generations_per_item):
-    ## create a numpy array from the genetic distance by generation values and the number of generations
+class PlotPoints:
+    def __init__(self, x: np.ndarray, y: np.ndarray):
+        self.x = x
+        self.y = y
 
-    y = np.array(distance_by_generation)
-    x = np.array(range(len(distance_by_generation)))
+    def points(self) -> tuple:
+        return self.x, self.y
+
+
+"""
+Function that bins the points of a trajectory to the given number of bins (the width of the figure in pixels by
+default), keeping the smallest and largest genetic distance of each bin as well as the very last point. Trajectories
+with no more than two points per bin are returned as they are.
+"""
+def bin_points(x: np.ndarray, y: np.ndarray, bins: int = None) -> tuple:
+    if bins is None:
+        bins = int(plt.rcParams["figure.figsize"][0] * plt.rcParams["figure.dpi"])
+    if len(x) <= 2 * bins:
+        return x, y
+
+    ## the index of the first point of every bin that has any points in it
+    edges = np.linspace(x[0], x[-1], bins + 1)[:-1]
+    starts = np.unique(np.searchsorted(x, edges))
+
+    binned_x = np.repeat(x[starts], 2)
+    binned_y = np.column_stack((np.minimum.reduceat(y, starts), np.maximum.reduceat(y, starts))).ravel()
+    return np.append(binned_x, x[-1]), np.append(binned_y, y[-1])
+
+
+"""
+Function that returns the binned points of a trajectory ready to draw
+"""
+def plot_points(distance_by_generation) -> tuple:
+    x, y = trajectory_points(distance_by_generation)
+    return bin_points(x, y)
+
+
+"""
+Function that shows the current graph, or saves it to the output path (and closes it) if one is given
+"""
+def finish_plot(output_path=None):
+    if output_path is None:
+        plt.show()
+    else:
+        plt.savefig(output_path)
+        plt.close()
+
+
+"""
+Function for plotting a single scatter plot of the genetic distance by generation
+"""
+def plot_data(distance_by_generation, graph_title, color, generations_per_item, output_path=None):
+    ## create numpy arrays of the generations and their genetic distances, binned to the width of the graph
+    x, y = plot_points(distance_by_generation)
 
     ## set the plot title and labels
     plt.title(graph_title)
     plt.xlabel("Generation (x 10^" + str(math.log(generations_per_item, 10)) + ")")
     plt.ylabel("Genetic Distance")
 
-    ## plot the graph and show
-    plt.scatter(x, y, s=5, color=color)
-    plt.show()
+    ## plot the graph and show (or save) it
+    plt.scatter(x, y, s=5, color=color, rasterized=len(x) > RASTERIZE_POINTS)
+    finish_plot(output_path)
 
 
 """
 Function for plotting an overlay of all scatter plots of the genetic distance by generation from the different models
 """
-def plot_all_data(distance_by_generation_JC, distance_by_generation_K2P, distance_by_generation_HKY85, distance_by_generation_GTR, graph_title, generations_per_item):
-    ## create numpy arrays for graphing like when plotting a single graph
-    y_JC = np.array(distance_by_generation_JC)
-    x_JC = np.array(range(len(distance_by_generation_JC)))
-
-    y_K2P = np.array(distance_by_generation_K2P)
-    x_K2P = np.array(range(len(distance_by_generation_K2P)))
+def plot_all_data(distance_by_generation_JC, distance_by_generation_K2P, distance_by_generation_HKY85, distance_by_generation_GTR, graph_title, generations_per_item, output_path=None):
+    plot_overlay({"JC": distance_by_generation_JC, "K2P": distance_by_generation_K2P,
+                  "HKY85": distance_by_generation_HKY85, "GTR": distance_by_generation_GTR},
+                 graph_title, generations_per_item, output_path)
 
-    y_HKY85 = np.array(distance_by_generation_HKY85)
-    x_HKY85 = np.array(range(len(distance_by_generation_HKY85)))
-
-    y_GTR = np.array(distance_by_generation_GTR)
-    x_GTR = np.array(range(len(distance_by_generation_GTR)))
 
+"""
+Function for plotting an overlay of the scatter plots of the genetic distance by generation of any of the models, given
+as a dictionary of trajectories keyed by model name
+"""
+def plot_overlay(distances_by_model: dict, graph_title, generations_per_item, output_path=None):
     ## set the title and labels
     plt.title(graph_title)
     plt.xlabel("Generation (x 10^" + str(math.log(generations_per_item, 10)) + ")")
     plt.ylabel("Genetic Distance")
 
     ## plot each graph over each other with different colors and labels
-    plt.scatter(x_JC, y_JC, s=5, color="blue", label="JC")
-    plt.scatter(x_K2P, y_K2P, s=5, color="green", label="K2P")
-    plt.scatter(x_HKY85, y_HKY85, s=5, color="red", label="HKY85")
-    plt.scatter(x_GTR, y_GTR, s=5, color="orange", label="GTR")
+    for model, distance_by_generation in distances_by_model.items():
+        x, y = plot_points(distance_by_generation)
+        plt.scatter(x, y, s=5, color=MODEL_COLORS[model], label=model, rasterized=len(x) > RASTERIZE_POINTS)
     ## show the legend in the lower right corner of the graph
     plt.legend(loc="lower right")
-    ## show the graph
-    plt.show()
+    ## show (or save) the graph
+    finish_plot(output_path)
+
+
+"""
+Function that bins the trajectories in the arguments of a figure, so only what will be drawn is sent to a worker
+"""
+def bin_figure_arguments(arguments: tuple) -> tuple:
+    binned_arguments = []
+    for argument in arguments:
+        if isinstance(argument, dict):
+            argument = {model: PlotPoints(*plot_points(distance_by_generation))
+                        for model, distance_by_generation in argument.items()}
+        elif isinstance(argument, list) or hasattr(argument, "points"):
+            argument = PlotPoints(*plot_points(argument))
+        binned_arguments.append(argument)
+    return tuple(binned_arguments)
+
+
+"""
+Function that draws one figure in a worker process, where it is always saved to its output path
+"""
+def render_figure(figure: tuple):
+    plot_function, arguments = figure
+    plt.switch_backend("Agg")
+    plot_function(*arguments)
+
+
+"""
+Function to render many figures across a pool of worker processes (all the cores of the machine when workers is None,
+and in this process when workers is 1). Each figure is a plot function (plot_data or plot_overlay) and its arguments,
+which must include the output path to save to.
+"""
+def render_figures(figures: list, workers: int = None):
+    figures = [(plot_function, bin_figure_arguments(arguments)) for plot_function, arguments in figures]
+    if workers == 1:
+        for figure in figures:
+            render_figure(figure)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(render_figure, figures))
@@ -0,0 +1,182 @@
+"""
+This file evolves a whole population of haploid individuals from the input sequence, instead of the single lineage the
+simulation engines evolve.
+
+Every individual's sequence is packed 2 bits per nucleotide (4 nucleotides per byte, the first in the lowest bits, using
+the nucleotide codes of evolutionary_models.py), so a population of thousands of kilobase genomes takes a few megabytes
+instead of 8 bytes of list pointer per nucleotide. Each generation, mutations are applied to the whole population at
+once: the population's sites are treated as one long line and the candidate sites are found with geometric skips, like
+the SparseStepper, so the work scales with the number of mutations rather than the size of the population. The
+mutated nucleotides are written back by XOR-ing their 2 bit fields into the packed bytes.
+
+The number of sites of each individual that differ from the ancestor is kept up to date at the mutated sites, and can
+also be counted from scratch by XOR-ing the packed sequences with the packed ancestor and counting the nonzero 2 bit
+fields of each byte with a lookup table.
+
+A Population has the same step() interface as the steppers of evolutionary_models.py, with the population as a whole
+as its "sequence" (its genetic distance is the mean distance of the individuals from the ancestor), so the shared
+generation loop runs it with the consensus window, thresholds, trajectories, checkpoints and observers of the engines.
+"""
+
+import numpy as np
+
+from evolutionary_models import (ModelSpec, as_model_spec, calculate_nucleotide_frequencies, decode_sequence,
+                                 encode_sequence, run_generations, threshold_genetic_distance)
+from predictor import ExpectedCurve
+
+## the number of nonzero 2 bit fields of every byte, i.e. the number of differing nucleotides in the XOR of two packed
+## bytes
+DIFFERING_NUCLEOTIDES = np.array([sum(((byte >> shift) & 3) != 0 for shift in (0, 2, 4, 6)) for byte in range(256)],
+                                 dtype=np.uint8)
+
+
+"""
+Functions to pack a uint8 array of nucleotide codes into 4 nucleotides per byte (padded with A at the end), and to
+unpack it again given the number of nucleotides. The last axis is the sequence, so a sequences x sites array packs and
+unpacks row by row.
+"""
+def pack_sequence(codes: np.ndarray) -> np.ndarray:
+    codes = np.asarray(codes, dtype=np.uint8)
+    padded = np.zeros(codes.shape[:-1] + (-(-codes.shape[-1] // 4) * 4,), dtype=np.uint8)
+    padded[..., :codes.shape[-1]] = codes
+    fields = padded.reshape(padded.shape[:-1] + (-1, 4))
+    return fields[..., 0] | (fields[..., 1] << 2) | (fields[..., 2] << 4) | (fields[..., 3] << 6)
+
+
+def unpack_sequence(packed: np.ndarray, length: int) -> np.ndarray:
+    fields = (packed[..., None] >> np.array([0, 2, 4, 6], dtype=np.uint8)) & 3
+    return fields.reshape(packed.shape[:-1] + (-1,))[..., :length]
+
+
+"""
+A population of haploid individuals that all start as the given nucleotide sequence, evolved together one generation
+at a time under a compiled model
+"""
+class Population:
+    def __init__(self, model_spec: ModelSpec, nucleotide_sequence: list, size: int, rng):
+        if size < 1:
+            raise ValueError("A population needs at least 1 individual")
+
+        ## probabilities of each nucleotide mutating to each other nucleotide, and the candidate probability the sites
+        ## are skipped through with (see SparseStepper)
+        mutation_probabilities = model_spec.probabilities.copy()
+        np.fill_diagonal(mutation_probabilities, 0.0)
+        self.mutation_cumulative = np.cumsum(mutation_probabilities, axis=1)
+        self.candidate_probability = self.mutation_cumulative[:, -1].max()
+        if self.candidate_probability <= 0:
+            raise ValueError("The mutation table never mutates any nucleotide, so the simulation can never finish")
+
+        self.size = size
+        self.sequence_length = len(nucleotide_sequence)
+        self.original_sequence = pack_sequence(encode_sequence(nucleotide_sequence))
+        self.sequences = np.tile(self.original_sequence, (size, 1))
+        self.rng = rng
+
+        ## the whole population's sites count as the length of its "sequence" in the generation loop
+        self.length = size * self.sequence_length
+        self.individual_differences = np.zeros(size, dtype=np.int64)
+        self.differences = 0
+        self.mutations = 0
+
+        ## draw enough skip distances in a block to usually cover a whole generation
+        self.block_size = max(64, int(1.1 * self.length * self.candidate_probability) + 16)
+
+    ## the sites of the population (counted along all of the individuals in order) that are candidates to mutate
+    def candidate_sites(self) -> np.ndarray:
+        blocks = []
+        last_site = -1
+        while last_site < self.length:
+            sites = last_site + np.cumsum(self.rng.geometric(self.candidate_probability, self.block_size))
+            blocks.append(sites)
+            last_site = sites[-1]
+        sites = np.concatenate(blocks)
+        return sites[:np.searchsorted(sites, self.length)]
+
+    def step(self) -> int:
+        sites = self.candidate_sites()
+        if len(sites) == 0:
+            return self.differences
+
+        individuals, positions = np.divmod(sites, self.sequence_length)
+        bytes_in_sequence = positions >> 2
+        byte_indices = individuals * self.sequences.shape[1] + bytes_in_sequence
+        shifts = ((positions & 3) << 1).astype(np.uint8)
+        packed = self.sequences.reshape(-1)
+        nucleotides = (packed[byte_indices] >> shifts) & 3
+
+        ## the number of cumulative mutation probabilities at or below the random number is the nucleotide it mutates
+        ## to, and a random number past all of them (4) means the site does not mutate
+        random_floats = self.rng.random(len(sites)) * self.candidate_probability
+        mutated = np.count_nonzero(random_floats[:, None] >= self.mutation_cumulative[nucleotides], axis=1)
+        changed = mutated != 4
+        individuals, bytes_in_sequence, byte_indices, shifts = (individuals[changed], bytes_in_sequence[changed],
+                                                                 byte_indices[changed], shifts[changed])
+        nucleotides, mutated = nucleotides[changed], mutated[changed].astype(np.uint8)
+
+        original_nucleotides = (self.original_sequence[bytes_in_sequence] >> shifts) & 3
+        change = (mutated != original_nucleotides).astype(np.int64) - (nucleotides != original_nucleotides)
+        np.add.at(self.individual_differences, individuals, change)
+        ## every site is in its own 2 bit field, so XOR-ing in the change of each site is right even when several
+        ## sites share a byte
+        np.bitwise_xor.at(packed, byte_indices, (nucleotides ^ mutated) << shifts)
+
+        self.mutations += len(mutated)
+        self.differences += int(change.sum())
+        return self.differences
+
+    ## the genetic distance of every individual from the ancestor, counted from scratch with XOR and a lookup table
+    def distances(self) -> np.ndarray:
+        differing = DIFFERING_NUCLEOTIDES[self.sequences ^ self.original_sequence]
+        return differing.sum(axis=1, dtype=np.int64) / self.sequence_length
+
+    ## the sequence of one individual as a list of one character strings
+    def individual_sequence(self, individual: int) -> list:
+        return decode_sequence(unpack_sequence(self.sequences[individual], self.sequence_length))
+
+    ## the state of the population to save in a checkpoint, and restoring it (see checkpoint.py)
+    def get_state(self) -> dict:
+        return {"original_sequence": self.original_sequence, "sequences": self.sequences,
+                "individual_differences": self.individual_differences, "differences": self.differences,
+                "mutations": self.mutations}
+
+    def set_state(self, state: dict):
+        if state["sequences"].shape != self.sequences.shape:
+            raise ValueError("The checkpoint is of a population of " + str(len(state["sequences"])) +
+                             " individuals, not " + str(self.size))
+        self.sequences = state["sequences"].astype(np.uint8)
+        self.individual_differences = state["individual_differences"].astype(np.int64)
+        self.differences = int(state["differences"])
+        self.mutations = int(state["mutations"])
+
+
+"""
+Function to evolve a population of the given number of haploid individuals from a nucleotide sequence until the mean
+genetic distance of the individuals from it reaches the threshold (over the consensus generations, like the single
+lineage engines). The rng is a numpy Generator (one is made if it is not given), and the threshold, trajectory,
+checkpoint, observer and crossings are as for the simulation engines. The mean of a large population hardly fluctuates,
+so a threshold above the distance the model settles at (0.75 for Jukes-Cantor, less for the others, see predictor.py)
+would never be reached, and raises a ValueError instead of running forever; lower thresholds are better suited to
+populations.
+
+Returns the list of the mean genetic distance of the population by generation, and the final Population
+"""
+def simulate_population(model_spec, nucleotide_sequence: list, size: int = 100, rng=None, threshold=None,
+                        trajectory=None, checkpoint=None, observer=None, crossings=None) -> tuple:
+    if rng is None:
+        rng = np.random.default_rng()
+    model_spec = as_model_spec(model_spec)
+
+    if threshold is None:
+        threshold = threshold_genetic_distance
+    largest_threshold = max(threshold) if isinstance(threshold, (list, tuple)) else threshold
+    curve = ExpectedCurve(model_spec, calculate_nucleotide_frequencies(nucleotide_sequence),
+                          len(nucleotide_sequence) * size)
+    ## a threshold right at the settling distance is still reached by the fluctuations around it
+    if curve.settled_distance < largest_threshold - 1e-9:
+        raise ValueError("The mean genetic distance of the population settles at " +
+                         str(round(curve.settled_distance, 4)) + " under the " + model_spec.model +
+                         " model, so it never reaches the threshold of " + str(largest_threshold))
+
+    population = Population(model_spec, nucleotide_sequence, size, rng)
+    distance_by_generation = run_generations(population, threshold, trajectory, checkpoint, observer, crossings)
+    return distance_by_generation, population
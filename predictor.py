@@ -0,0 +1,325 @@
+"""
+This file predicts what a simulation will do without simulating it: the expected genetic distance from the original
+sequence at every generation, and about how many generations the simulation will take to reach the genetic distance
+threshold.
+
+Every site of the sequence evolves independently under the same one generation mutation probabilities P (the compiled
+model's probabilities, which already stand for generations_per_step real generations). A site that starts as
+nucleotide b still matches it after t generations with probability (P^t)_bb, so the expected genetic distance is
+
+    E[d(t)] = sum over b of f_b (1 - (P^t)_bb)
+
+where f_b is the frequency of b in the original sequence. P^t comes from the eigendecomposition of P (symmetrized with
+its stationary frequencies, as the models are reversible), so the whole curve costs the same however many generations
+it covers. As the sites are independent, the number of differing sites is a sum of independent coin flips, and the
+standard deviation of d(t) is sqrt(sum over b of f_b p_b (1 - p_b) / n) for n sites, where p_b = 1 - (P^t)_bb.
+
+The curve rises towards the distance the model settles at (0.75 for Jukes-Cantor, less for models whose stationary
+nucleotide frequencies are uneven). How the threshold is reached depends on where it is:
+    - well below the settling distance (more than 3 standard deviations), the consensus generations reach it about when
+      the expected curve does, and the spread of that time is the standard deviation of d(t) over the slope of the curve
+    - near or above it, the distance has to fluctuate up to the threshold. The distance is then treated as an
+      Ornstein-Uhlenbeck process around the settling distance, relaxing at the average rate of the eigenvalues of P, and
+      the mean time of it first reaching the threshold is added to the time the curve takes to come within 3 standard
+      deviations of the settling distance. The spread of the waiting time is taken to be as large as its mean (as for an
+      exponential waiting time), on top of the spread of the time the curve comes within reach.
+These are approximations, best used to size and order simulations and to spot ones that went wrong, not to replace them.
+
+The predictions can presize the buffers of a simulation (e.g. the chunk size of a Trajectory), order the tasks of a
+batch by their expected cost (see scheduler.py), flag a simulation whose distances stray far from the expected curve
+(find_deviations, or the ExpectedCurveMonitor observer while it runs), and stand in for the replicates altogether in a
+quick parameter scan (see the --expectation-only option of sweep.py).
+"""
+
+import math
+
+import numpy as np
+
+from evolutionary_models import (NUCLEOTIDES, as_model_spec, calculate_nucleotide_frequencies, compile_model,
+                                 consensus_generations, threshold_genetic_distance)
+from instrumentation import RunObserver
+from trajectory import Trajectory
+
+## how many standard deviations below the settling distance a threshold must be to be reached by the rise of the curve
+DRIFT_STANDARD_DEVIATIONS = 3.0
+
+## eigenvalues this close to 1 are taken to be exactly 1 (the parts of the curve that never decay)
+UNIT_EIGENVALUE_TOLERANCE = 1e-12
+
+
+"""
+The expected genetic distance curve of a compiled model (or plain cumulative mutation table) for a sequence with the
+given nucleotide frequencies (a dictionary, as from calculate_nucleotide_frequencies) and number of sites
+"""
+class ExpectedCurve:
+    def __init__(self, model_spec, nucleotide_frequencies: dict, length: int):
+        model_spec = as_model_spec(model_spec)
+        self.frequencies = np.array([nucleotide_frequencies[nucleotide] for nucleotide in NUCLEOTIDES])
+        self.length = length
+
+        self.probabilities = model_spec.probabilities
+        stationary = stationary_frequencies(self.probabilities)
+        flows = stationary[:, None] * self.probabilities
+        if np.all(stationary > 0) and np.allclose(flows, flows.T, rtol=0, atol=1e-12):
+            ## a reversible model (as all four of the study are): D^1/2 P D^-1/2 is symmetric, D being the diagonal of
+            ## the stationary frequencies, so its eigendecomposition stays well conditioned even when eigenvalues repeat
+            ## (e.g. a leap so long every row of P is the stationary frequencies), and (P^t)_bb = sum over k of
+            ## weights[b, k] * eigenvalues[k]^t with the weights the squares of its eigenvectors
+            roots = np.sqrt(stationary)
+            self.eigenvalues, eigenvectors = np.linalg.eigh(self.probabilities * roots[:, None] / roots[None, :])
+            self.weights = eigenvectors ** 2
+        else:
+            ## otherwise the eigenvectors of P can be nearly parallel, so the powers of P are taken by repeated squaring
+            self.eigenvalues = np.linalg.eigvals(self.probabilities)
+            self.weights = None
+
+        unit = np.abs(self.eigenvalues - 1) < UNIT_EIGENVALUE_TOLERANCE
+        if self.weights is not None:
+            settled_matches = np.clip(self.weights[:, unit].sum(axis=1), 0.0, 1.0)
+        else:
+            settled_matches = 1 - self.mismatch_probabilities(2 ** 62)
+        self.settled_distance = float(np.dot(self.frequencies, 1 - settled_matches))
+        self.settled_deviation = math.sqrt(np.dot(self.frequencies, settled_matches * (1 - settled_matches)) / length)
+
+        ## once settled, the distance forgets where it was at the rates of the decaying parts of the curve: each part k
+        ## adds sum over b of f_b pi_b weights[b, k] eigenvalues[k]^s to the covariance of distances s generations apart
+        ## (pi_b being the settled chance of a site matching b), so the relaxation time is the average of their decay
+        ## times weighted by those covariances (or the decay time of the slowest part, without the weights)
+        decay_rates = np.abs(self.eigenvalues[~unit])
+        if self.weights is not None:
+            covariances = (self.frequencies * settled_matches) @ self.weights[:, ~unit]
+        else:
+            covariances = (decay_rates == decay_rates.max()).astype(np.float64) if len(decay_rates) else decay_rates
+        decaying = (covariances > 0) & (decay_rates > 0) & (decay_rates < 1)
+        if np.any(decaying):
+            decay_times = -1 / np.log(decay_rates[decaying])
+            self.relaxation_generations = float(np.average(decay_times, weights=covariances[decaying]))
+        else:
+            self.relaxation_generations = 1.0
+
+    ## the probability of a site that started as each nucleotide differing from it after each number of generations
+    def mismatch_probabilities(self, generations) -> np.ndarray:
+        if self.weights is not None:
+            powers = self.eigenvalues ** np.asarray(generations, dtype=np.float64)[..., None]
+            matches = powers @ self.weights.T
+        else:
+            matches = np.diagonal(matrix_powers(self.probabilities, generations), axis1=-2, axis2=-1)
+        return np.clip(1 - matches, 0.0, 1.0)
+
+    ## the expected genetic distance after each number of generations
+    def mean(self, generations) -> np.ndarray:
+        return self.mismatch_probabilities(generations) @ self.frequencies
+
+    ## the standard deviation of the genetic distance after each number of generations
+    def standard_deviation(self, generations) -> np.ndarray:
+        mismatches = self.mismatch_probabilities(generations)
+        return np.sqrt((mismatches * (1 - mismatches)) @ self.frequencies / self.length)
+
+    ## the expected genetic distance by generation, from generation 0 up to (not including) the given number of
+    ## generations, in the same form the simulation engines return
+    def distance_by_generation(self, generations: int) -> list:
+        return self.mean(np.arange(generations)).tolist()
+
+    ## the first generation at which the expected distance averaged over the consensus generations reaches the target,
+    ## found by doubling then bisecting (the expected curve only rises). None if it never does.
+    def crossing_generation(self, target: float):
+        if self.settled_distance < target:
+            return None
+
+        def window_average(generation: int) -> float:
+            return float(np.mean(self.mean(np.arange(max(0, generation - consensus_generations + 1), generation + 1))))
+
+        high = 1
+        while window_average(high) < target:
+            high *= 2
+            if high > 2 ** 62:
+                return None
+        low = high // 2
+        while low < high:
+            middle = (low + high) // 2
+            if window_average(middle) >= target:
+                high = middle
+            else:
+                low = middle + 1
+        return high
+
+    """
+    Predicts how many generations a simulation takes to reach the genetic distance threshold (the user defined
+    threshold unless another is given), counted as the length of its distance_by_generation. Returns a dictionary of
+    the expected number of generations, its approximate standard deviation, and which of the two ways of reaching the
+    threshold described at the top of this file it is ("drift" or "fluctuation"). The expected number of generations is
+    infinite when the threshold is too far above the settling distance to ever be reached in practice.
+    """
+    def predict_generations(self, threshold: float = None) -> dict:
+        if threshold is None:
+            threshold = threshold_genetic_distance
+        drift_limit = self.settled_distance - DRIFT_STANDARD_DEVIATIONS * self.settled_deviation
+
+        if threshold <= drift_limit:
+            generation = self.crossing_generation(threshold)
+            return {"generations": float(generation + 1), "sd": self.crossing_deviation(generation), "regime": "drift"}
+
+        ## the time to come within reach of the settling distance, and then the mean time for the fluctuations to reach
+        ## the threshold (in standard deviations from the settling distance) from there
+        settling_generation = self.crossing_generation(drift_limit) if drift_limit > 0 else 0
+        if settling_generation is None or self.settled_deviation == 0:
+            return {"generations": math.inf, "sd": math.inf, "regime": "fluctuation"}
+        level = (threshold - self.settled_distance) / self.settled_deviation
+        waiting = self.relaxation_generations * ornstein_uhlenbeck_passage_time(-DRIFT_STANDARD_DEVIATIONS, level)
+        deviation = math.hypot(self.crossing_deviation(settling_generation), waiting)
+        return {"generations": settling_generation + 1 + waiting, "sd": deviation, "regime": "fluctuation"}
+
+    ## the standard deviation of the generation the distance rises past a level at, from the standard deviation of the
+    ## distance there over the slope of the expected curve
+    def crossing_deviation(self, generation: int) -> float:
+        slope = float(self.mean(generation) - self.mean(max(0, generation - 1)))
+        return float(self.standard_deviation(generation)) / slope if slope > 0 else 0.0
+
+
+"""
+Function that finds the stationary nucleotide frequencies of a mutation probability matrix, pi P = pi with the
+frequencies adding up to 1
+"""
+def stationary_frequencies(probabilities: np.ndarray) -> np.ndarray:
+    equations = np.vstack([probabilities.T - np.identity(len(probabilities)), np.ones(len(probabilities))])
+    solution = np.linalg.lstsq(equations, np.append(np.zeros(len(probabilities)), 1.0), rcond=None)[0]
+    return np.clip(solution, 0.0, None)
+
+
+"""
+Function that raises a mutation probability matrix to each of an array of whole numbers of generations at once, by
+repeated squaring. Returns an array of matrices with the shape of the generations in front.
+"""
+def matrix_powers(matrix: np.ndarray, generations) -> np.ndarray:
+    generations = np.rint(np.asarray(generations, dtype=np.float64)).astype(np.int64)
+    powers = np.broadcast_to(np.identity(len(matrix)), generations.shape + matrix.shape).copy()
+    square = matrix.copy()
+    remaining = generations.copy()
+    while np.any(remaining > 0):
+        odd = (remaining & 1) == 1
+        powers[odd] = powers[odd] @ square
+        remaining >>= 1
+        ## keeps the rows adding up to 1, or the rounding errors would double with every squaring
+        square = square @ square
+        square /= square.sum(axis=-1, keepdims=True)
+    return powers
+
+
+"""
+Function for the mean time (in units of the relaxation time) an Ornstein-Uhlenbeck process with unit stationary
+standard deviation takes to first reach the level from the start (both in standard deviations from its mean):
+sqrt(pi / 2) times the integral from start to level of exp(x^2 / 2) (1 + erf(x / sqrt(2))). Infinite for levels so high
+the integral overflows.
+"""
+def ornstein_uhlenbeck_passage_time(start: float, level: float, points: int = 2001) -> float:
+    if level <= start:
+        return 0.0
+    if level > 37:
+        return math.inf
+    x = np.linspace(start, level, points)
+    integrand = np.exp(x ** 2 / 2) * (1 + np.array([math.erf(value / math.sqrt(2)) for value in x]))
+    return math.sqrt(math.pi / 2) * float(np.sum((integrand[1:] + integrand[:-1]) / 2 * np.diff(x)))
+
+
+"""
+Function that builds the expected curve of the named model for a nucleotide sequence, compiled the same way the
+simulations compile it
+"""
+def expected_curve(model: str, nucleotide_sequence: list, generations_per_step: int = 1,
+                   parameters: dict = None) -> ExpectedCurve:
+    return ExpectedCurve(compile_model(model, nucleotide_sequence, generations_per_step, parameters),
+                         calculate_nucleotide_frequencies(nucleotide_sequence), len(nucleotide_sequence))
+
+
+"""
+Function that predicts how many generations a simulation of the named model for a nucleotide sequence takes to reach
+the threshold (see ExpectedCurve.predict_generations). Given a list of thresholds, returns a dictionary of the
+prediction for each of them, keyed by threshold.
+"""
+def predict_generations(model: str, nucleotide_sequence: list, generations_per_step: int = 1, parameters: dict = None,
+                        threshold=None):
+    curve = expected_curve(model, nucleotide_sequence, generations_per_step, parameters)
+    if isinstance(threshold, (list, tuple)):
+        return {value: curve.predict_generations(value) for value in sorted(threshold)}
+    return curve.predict_generations(threshold)
+
+
+"""
+Function for the expectation only mode: returns the expected genetic distance by generation of a simulation of the
+named model for a nucleotide sequence, up to the expected number of generations to reach the threshold, without
+simulating anything. For a threshold reached by fluctuation, the expected curve has levelled off well before then, so
+it is given up to at most max_generations (and up to max_generations for a threshold it never reaches).
+"""
+def expected_distance_by_generation(model: str, nucleotide_sequence: list, generations_per_step: int = 1,
+                                    parameters: dict = None, threshold: float = None,
+                                    max_generations: int = 10 ** 7) -> list:
+    curve = expected_curve(model, nucleotide_sequence, generations_per_step, parameters)
+    generations = curve.predict_generations(threshold)["generations"]
+    ## a threshold that is never reached in practice is expected to take infinitely many generations
+    if math.isinf(generations):
+        return curve.distance_by_generation(max_generations)
+    return curve.distance_by_generation(min(max_generations, math.ceil(generations)))
+
+
+"""
+Function that builds a Trajectory (see trajectory.py) for a simulation of the named model for a nucleotide sequence,
+with its chunks sized to hold the whole run (up to the expected number of generations plus 3 standard deviations)
+unless that is larger than max_chunk_size values. The other options are passed on to the Trajectory.
+"""
+def presized_trajectory(model: str, nucleotide_sequence: list, generations_per_step: int = 1, parameters: dict = None,
+                        threshold: float = None, stride: int = 1, decimation: str = "stride", spill_path: str = None,
+                        max_chunk_size: int = 2 ** 22):
+    prediction = predict_generations(model, nucleotide_sequence, generations_per_step, parameters, threshold)
+    generations = min(prediction["generations"] + 3 * prediction["sd"], max_chunk_size * stride)
+    ## min-max decimation keeps two values per block of stride generations
+    values = math.ceil(generations / stride) * (2 if decimation == "minmax" else 1)
+    return Trajectory(stride, decimation, spill_path, chunk_size=max(1024, min(max_chunk_size, values)))
+
+
+"""
+Function that finds the generations of a simulation whose genetic distance is further from the expected curve than
+tolerance standard deviations (plus one site, so short sequences are not flagged for a single mutation). Takes a list of
+genetic distances by generation or a Trajectory. Returns the flagged generations as an array.
+"""
+def find_deviations(distance_by_generation, curve: ExpectedCurve, tolerance: float = 5.0) -> np.ndarray:
+    if hasattr(distance_by_generation, "points"):
+        generations, distances = distance_by_generation.points()
+    else:
+        distances = np.asarray(distance_by_generation, dtype=np.float64)
+        generations = np.arange(len(distances))
+    allowed = tolerance * curve.standard_deviation(generations) + 1 / curve.length
+    return generations[np.abs(distances - curve.mean(generations)) > allowed]
+
+
+"""
+Observer (see instrumentation.py) that compares the genetic distance of a running simulation with its expected curve
+every so many generations, and records every sample further from it than tolerance standard deviations (see
+find_deviations) in deviations, as a dictionary of the generation, the distance and the expected distance. The callback,
+if given, is called with each of them as it is found (e.g. to stop or log a simulation that has gone wrong).
+"""
+class ExpectedCurveMonitor(RunObserver):
+    def __init__(self, curve: ExpectedCurve, every: int = 1000, tolerance: float = 5.0, callback=None):
+        super().__init__(every)
+        self.curve = curve
+        self.tolerance = tolerance
+        self.callback = callback
+        self.deviations = []
+        self.last_checked = None
+
+    def sample(self, generation: int, stepper, window):
+        self.check(generation, stepper)
+
+    def finish(self, generation: int, stepper, window):
+        if generation != self.last_checked:
+            self.check(generation, stepper)
+
+    def check(self, generation: int, stepper):
+        self.last_checked = generation
+        distance = stepper.differences / stepper.length
+        expected = float(self.curve.mean(generation))
+        allowed = self.tolerance * float(self.curve.standard_deviation(generation)) + 1 / self.curve.length
+        if abs(distance - expected) > allowed:
+            deviation = {"generation": generation, "distance": distance, "expected_distance": expected}
+            self.deviations.append(deviation)
+            if self.callback is not None:
+                self.callback(deviation)
@@ -0,0 +1,166 @@
+"""
+This file checks two guarantees of the simulation engines that the rest of the program relies on, so a change that
+breaks either is caught before its results are trusted:
+    - the NumPy engine gives exactly the same genetic distances by generation as the pure Python engine when both draw
+      the same random numbers (both are given a numpy Generator from the same seed, which the pure Python stepper
+      draws one number per site from, and the NumPy stepper one block per generation from)
+    - a simulation stopped part way and resumed from its latest checkpoint gives bit-identical results to one that
+      was never stopped, on every engine, with the distances recorded in a plain list, in a Trajectory, and in a
+      Trajectory that spills its chunks to a file
+The simulation is "stopped" by an observer that raises an exception a little after a checkpoint was saved, so the
+resumed run has to redo the generations in between.
+
+Every check runs offline on a synthetic random sequence in a few seconds. Failed checks are printed, and the exit
+status is 1 if there were any.
+
+Example:
+    python regression_checks.py
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+from benchmark import synthetic_sequence
+from checkpoint import Checkpoint
+from evolutionary_models import ENGINES, MODELS, compile_model, make_rng, run_engine
+from instrumentation import RunObserver
+from trajectory import Trajectory
+
+## the length of the synthetic sequence, short enough for the pure Python engine to reach the threshold quickly
+CHECK_LENGTH = 300
+
+## a checkpoint is saved every this many generations, and the simulation stopped at the first multiple of this many
+CHECKPOINT_GENERATIONS = 100
+STOP_GENERATIONS = 250
+
+## the chunk size of the Trajectory checks, small enough for the spilled one to spill many times before it is stopped
+CHECK_CHUNK_SIZE = 64
+
+STORAGES = ["list", "trajectory", "spilled trajectory"]
+
+
+"""
+Raised by StopSimulation to stop a simulation part way, as if the process running it had died
+"""
+class SimulationStopped(Exception):
+    pass
+
+
+"""
+Observer (see instrumentation.py) that stops a simulation the first time it is sampled
+"""
+class StopSimulation(RunObserver):
+    def sample(self, generation: int, stepper, window):
+        raise SimulationStopped("Stopped at generation " + str(generation))
+
+
+"""
+Function that checks that the pure Python and NumPy engines give the same genetic distances by generation (and the
+same final sequence) for the given model when they draw the same random numbers. Returns whether they do.
+"""
+def check_engines_agree(model: str, seed: int = 0) -> bool:
+    nucleotide_sequence = synthetic_sequence(CHECK_LENGTH, seed)
+    model_spec = compile_model(model, nucleotide_sequence)
+
+    python_sequence = nucleotide_sequence.copy()
+    python_distances = run_engine("python", model_spec, python_sequence, np.random.default_rng(seed))
+    numpy_sequence = nucleotide_sequence.copy()
+    numpy_distances = run_engine("numpy", model_spec, numpy_sequence, np.random.default_rng(seed))
+    return python_distances == numpy_distances and python_sequence == numpy_sequence
+
+
+"""
+Function that makes the place the genetic distances by generation are recorded in for the named kind of storage (see
+STORAGES), spilling to a file in the given directory if it is the spilled trajectory
+"""
+def make_storage(storage: str, directory: str):
+    if storage == "list":
+        return []
+    if storage == "trajectory":
+        return Trajectory(chunk_size=CHECK_CHUNK_SIZE)
+    return Trajectory(spill_path=os.path.join(directory, "distances.f32"), chunk_size=CHECK_CHUNK_SIZE)
+
+
+## the genetic distances by generation recorded in a list or a Trajectory, as an array to compare
+def recorded_distances(distance_by_generation) -> np.ndarray:
+    if isinstance(distance_by_generation, Trajectory):
+        distance_by_generation.close()
+        return np.concatenate(distance_by_generation.points())
+    return np.array(distance_by_generation)
+
+
+"""
+Function that checks that a simulation on the given engine, recording its distances in the given kind of storage, gives
+bit-identical distances by generation and final sequence when it is stopped part way and resumed from its checkpoint
+as when it runs straight through. Returns whether it does.
+"""
+def check_resume(engine: str, storage: str, model: str = "GTR", seed: int = 0) -> bool:
+    nucleotide_sequence = synthetic_sequence(CHECK_LENGTH, seed)
+    model_spec = compile_model(model, nucleotide_sequence)
+
+    with tempfile.TemporaryDirectory() as directory:
+        straight_sequence = nucleotide_sequence.copy()
+        straight = recorded_distances(run_engine(engine, model_spec, straight_sequence,
+                                                 make_rng(engine, np.random.SeedSequence(seed)),
+                                                 trajectory=make_storage(storage, directory)))
+
+        checkpoint = Checkpoint(os.path.join(directory, "simulation.npz"), every_generations=CHECKPOINT_GENERATIONS,
+                                every_seconds=None)
+        stopped_storage = make_storage(storage, directory)
+        try:
+            run_engine(engine, model_spec, nucleotide_sequence.copy(), make_rng(engine, np.random.SeedSequence(seed)),
+                       trajectory=stopped_storage, checkpoint=checkpoint, observer=StopSimulation(STOP_GENERATIONS))
+        except SimulationStopped:
+            pass
+        else:
+            raise ValueError("The " + model + " simulation finished before it could be stopped at generation " +
+                             str(STOP_GENERATIONS))
+        ## the stopped process would have let go of its spill file
+        if isinstance(stopped_storage, Trajectory):
+            stopped_storage.close()
+
+        ## the resumed run starts from a differently seeded generator, as everything it needs is in the checkpoint
+        resumed_sequence = nucleotide_sequence.copy()
+        resumed = recorded_distances(run_engine(engine, model_spec, resumed_sequence,
+                                                make_rng(engine, np.random.SeedSequence(seed + 1)),
+                                                trajectory=make_storage(storage, directory), checkpoint=checkpoint))
+
+    return np.array_equal(straight, resumed) and straight_sequence == resumed_sequence
+
+
+"""
+Function that runs every check, printing the result of each one. Returns the names of the checks that failed.
+"""
+def run_checks(models: list = MODELS, engines: list = list(ENGINES), seed: int = 0) -> list:
+    checks = [("python and numpy engines agree for " + model, check_engines_agree, (model, seed)) for model in models]
+    checks += [(engine + " engine resumes bit-identically with a " + storage, check_resume,
+                (engine, storage, "GTR", seed)) for engine in engines for storage in STORAGES]
+
+    failures = []
+    for name, check, arguments in checks:
+        passed = check(*arguments)
+        print(name.ljust(72), "ok" if passed else "FAILED")
+        if not passed:
+            failures.append(name)
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that the engines agree and that checkpoints resume exactly")
+    parser.add_argument("--models", nargs="+", choices=MODELS, default=MODELS)
+    parser.add_argument("--engines", nargs="+", choices=list(ENGINES), default=list(ENGINES))
+    parser.add_argument("--seed", type=int, default=0)
+    arguments = parser.parse_args()
+
+    failures = run_checks(arguments.models, arguments.engines, arguments.seed)
+    if failures:
+        print(len(failures), "checks failed")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
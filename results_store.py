@@ -0,0 +1,170 @@
+"""
+This file keeps the results of simulations in a SQLite database, instead of copying the printed dictionaries into the
+results txt files by hand, and serves repeated simulations from it instead of running them again.
+
+Every replicate is stored under a key that is the sha256 hash of everything that decides its result: the nucleotide
+sequence, the model, the mutation rates (with any the run did not set filled in from evolutionary_models.py), the
+genetic distance threshold, the master seed (and seed stream), the engine and the generations per step. The same
+replicate asked for again (e.g. rerunning a report after changing a plot) is read back from the store, with its genetic
+distances by generation if they were kept, and only the replicates that are missing are simulated. Only a replicate that
+kept every generation stores its distances; one asked for with fewer (a stride or min-max decimation) is thinned out
+from them.
+
+It also computes the summary statistics of the study (the mean, standard deviation and confidence interval of the
+number of generations of each model) for all the models at once with array operations.
+"""
+
+import hashlib
+import json
+import sqlite3
+
+import numpy as np
+
+from evolutionary_models import model_parameters, threshold_genetic_distance
+from parallel_runner import distance_storage, run_tasks
+from trajectory import Trajectory
+
+## two sided 95% critical values of Student's t distribution by degrees of freedom, used for the confidence intervals of
+## small numbers of replicates (1.96 of the normal distribution is used past 30)
+T_CRITICAL_95 = {1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365, 8: 2.306, 9: 2.262, 10: 2.228,
+                 11: 2.201, 12: 2.179, 13: 2.160, 14: 2.145, 15: 2.131, 16: 2.120, 17: 2.110, 18: 2.101, 19: 2.093,
+                 20: 2.086, 21: 2.080, 22: 2.074, 23: 2.069, 24: 2.064, 25: 2.060, 26: 2.056, 27: 2.052, 28: 2.048,
+                 29: 2.045, 30: 2.042}
+Z_CRITICAL_95 = 1.96
+
+
+"""
+Function that builds the key of the replicates of a task (see replicate_tasks in parallel_runner.py) from everything
+that decides their results
+"""
+def task_key(task: tuple) -> str:
+    model, replicate, sequence, engine, generations_per_step, parameters, threshold, master_seed, stream = task[:9]
+    settings = {
+        "sequence": hashlib.sha256(sequence.encode("ascii")).hexdigest(),
+        "model": model,
+        "parameters": model_parameters(parameters),
+        "threshold": threshold_genetic_distance if threshold is None else threshold,
+        "master_seed": master_seed,
+        "engine": engine,
+        "generations_per_step": generations_per_step,
+    }
+    ## stream 0 has the seeds replicates had before there were streams, so it keeps their keys too
+    if stream:
+        settings["stream"] = stream
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+"""
+A SQLite database of replicate results, with one row per replicate holding the number of generations it took,
+(optionally) its genetic distances by generation as float32, and for a run with a list of thresholds, the number of
+generations it took to reach each of them as JSON
+"""
+class ResultsStore:
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS replicates (key TEXT NOT NULL, replicate INTEGER NOT NULL, "
+                                "model TEXT NOT NULL, generations INTEGER NOT NULL, distances BLOB, crossings TEXT, "
+                                "PRIMARY KEY (key, replicate))")
+        self.connection.commit()
+
+    ## the stored result of one replicate in the same form run_replicate returns it, or None if it is not stored (or
+    ## its genetic distances are wanted but were not kept)
+    def get(self, task: tuple):
+        model, replicate = task[:2]
+        threshold, keep_distances = task[6], task[9]
+        row = self.connection.execute("SELECT generations, distances, crossings FROM replicates "
+                                      "WHERE key = ? AND replicate = ?", (task_key(task), replicate)).fetchone()
+        if isinstance(threshold, (list, tuple)):
+            return None if row is None or row[2] is None else (model, replicate, dict(json.loads(row[2])))
+        if row is None or (keep_distances and row[1] is None):
+            return None
+        if keep_distances:
+            stride, decimation = distance_storage(keep_distances)
+            values = np.frombuffer(row[1], dtype=np.float32)
+            trajectory = Trajectory(stride, decimation, chunk_size=max(1, len(values)))
+            for value in values.tolist():
+                trajectory.append(value)
+            return model, replicate, trajectory.compact()
+        return model, replicate, row[0]
+
+    def put(self, task: tuple, result: tuple):
+        model, replicate, distances = result
+        blob = crossings = None
+        if isinstance(distances, dict):
+            generations, crossings = max(distances.values()), json.dumps(list(distances.items()))
+        elif isinstance(distances, int):
+            generations = distances
+        elif hasattr(distances, "is_complete") and not distances.is_complete():
+            generations = len(distances)
+        else:
+            generations, blob = len(distances), np.asarray(distances, dtype=np.float32).tobytes()
+        ## a replicate stored with its distances is never replaced by the same replicate without them
+        self.connection.execute("INSERT INTO replicates VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (key, replicate) "
+                                "DO UPDATE SET distances = COALESCE(excluded.distances, distances)",
+                                (task_key(task), replicate, model, generations, blob, crossings))
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+"""
+Function that runs a list of replicate tasks like run_tasks, but serves every task already in the store from it and
+only simulates the rest, adding their results to the store. Returns the results in task order.
+"""
+def run_stored_tasks(tasks: list, store: ResultsStore, workers: int = None, chunksize: int = None) -> list:
+    results = [store.get(task) for task in tasks]
+    missing = [index for index, result in enumerate(results) if result is None]
+
+    if missing:
+        for index, result in zip(missing, run_tasks([tasks[index] for index in missing], workers, chunksize)):
+            results[index] = result
+            store.put(tasks[index], result)
+        store.commit()
+    return results
+
+
+"""
+Function that calculates the summary statistics of the number of generations each model took, for all the models in
+one pass over a models x replicates array. Returns a dictionary keyed by model name of the number of replicates, the
+mean, the standard deviation, and the lower and upper bounds of the 95% confidence interval of the mean (using Student's
+t distribution for 30 or fewer degrees of freedom). With a single replicate the standard deviation is nan and the
+interval unbounded, and with none every statistic but n is nan.
+"""
+def summarize_generations(generations_by_model: dict) -> dict:
+    models = list(generations_by_model)
+    most_replicates = max((len(generations) for generations in generations_by_model.values()), default=0)
+    ## models with fewer replicates are padded with nan, which the nan aware reductions skip
+    table = np.full((len(models), most_replicates), np.nan)
+    for row, model in enumerate(models):
+        table[row, :len(generations_by_model[model])] = generations_by_model[model]
+
+    counts = np.count_nonzero(~np.isnan(table), axis=1)
+    ## a model with no replicates has no mean, and one with a single replicate has no spread to bound the mean with
+    replicated = counts >= 2
+    means = np.full(len(models), np.nan)
+    means[counts > 0] = np.nanmean(table[counts > 0], axis=1)
+    deviations = np.full(len(models), np.nan)
+    deviations[replicated] = np.sqrt(np.nansum((table[replicated] - means[replicated, None]) ** 2, axis=1) /
+                                     (counts[replicated] - 1))
+    critical_values = np.array([T_CRITICAL_95.get(count - 1, Z_CRITICAL_95) for count in counts])
+    half_widths = np.where(counts == 1, np.inf, np.nan)
+    half_widths[replicated] = critical_values[replicated] * deviations[replicated] / np.sqrt(counts[replicated])
+
+    return {model: {"n": int(counts[row]), "mean": float(means[row]), "sd": float(deviations[row]),
+                    "ci_low": float(means[row] - half_widths[row]), "ci_high": float(means[row] + half_widths[row])}
+            for row, model in enumerate(models)}
+
+
+"""
+Function that prints the summary statistics of each model as a table
+"""
+def print_summary(summary: dict):
+    print("model".ljust(8), "n".rjust(4), "mean".rjust(12), "sd".rjust(12), "95% confidence interval".rjust(28))
+    for model, statistics in summary.items():
+        print(model.ljust(8), str(statistics["n"]).rjust(4), ("%.1f" % statistics["mean"]).rjust(12),
+              ("%.1f" % statistics["sd"]).rjust(12),
+              ("(%.1f, %.1f)" % (statistics["ci_low"], statistics["ci_high"])).rjust(28))
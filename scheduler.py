@@ -0,0 +1,215 @@
+"""
+This file schedules the simulations of many sequences at once, such as every gene record of one or more FASTA files,
+instead of running each gene as a separate program.
+
+Every replicate of every model of every sequence is handed to one shared pool of worker processes. The tasks are
+started longest expected job first, so the slowest genes do not end up running alone on one core at the end of the
+batch while the others sit idle. How long a task is expected to take comes from the length of its sequence and the
+number of generations it is predicted to take to reach the genetic distance threshold under its compiled model (see
+predictor.py): every generation costs about one pass over the sequence.
+
+The results are gathered back by sequence, with the same generations_by_model dictionary for each gene as the results
+txt files of the study.
+
+Instead of a fixed number of replicates of every model, the replicates can also be run adaptively: each model of each
+sequence keeps getting more replicates, in rounds, only until the confidence interval of its mean number of generations
+is as narrow as asked for. Models whose replicates hardly vary (e.g. Jukes-Cantor) stop after a few, and the compute
+goes to the models that spread widely (e.g. GTR).
+"""
+
+import math
+import os
+import re
+
+from evolutionary_models import MODELS
+from parallel_runner import gather_results, replicate_tasks, run_tasks, seed_stream
+from predictor import predict_generations
+from results_store import run_stored_tasks, summarize_generations
+from validate_input import codes_to_sequence, read_fasta_records
+
+
+"""
+A sequence to simulate: the name its results files are saved under, the title used on its plots, its nucleotide
+sequence, and the mutation rates of its gene (as from read_mutation_rates) if it has its own
+"""
+class SequenceRecord:
+    def __init__(self, name: str, title: str, nucleotide_sequence: list, parameters: dict = None):
+        self.name = name
+        self.title = title
+        self.nucleotide_sequence = nucleotide_sequence
+        self.parameters = parameters
+
+    ## the mutation rates to simulate the record with: its own, or else the rates the whole batch is run with
+    def rates(self, parameters: dict = None) -> dict:
+        return self.parameters if self.parameters is not None else parameters
+
+
+"""
+Function that reads every record of the given FASTA files. A file with a single record is named after the file (so its
+results files are named as before), and the records of a file with many are named after the first word of their
+header. The title of each record is the first word of its header, or the file name if it has no header. A record with
+no nucleotides raises a ValueError, and none of the records of its file are read. Names already taken (e.g. by the
+records of files read by an earlier call) can be given as a set, which the names of the new records are added to, so
+the records of every file of a batch get unique names however they are read. Every record gets the given mutation
+rates, if any (e.g. those of the gene's mutation rate txt file).
+"""
+def load_sequence_records(sequence_files: list, taken_names: set = None, parameters: dict = None) -> list:
+    records = []
+    names = taken_names if taken_names is not None else set()
+    for sequence_file in sequence_files:
+        file_records = list(read_fasta_records(sequence_file))
+        stem = os.path.splitext(os.path.basename(sequence_file))[0]
+        for header, codes in file_records:
+            if len(codes) == 0:
+                raise ValueError("The record " + repr(header) + " of " + sequence_file + " has no nucleotides")
+
+        for header, codes in file_records:
+            title = header.split()[0] if header else stem
+            name = stem if len(file_records) == 1 else re.sub(r"[^\w.-]", "_", title)
+            ## records with the same name get a number added, so their results files do not overwrite each other
+            unique_name = name
+            number = 2
+            while unique_name in names:
+                unique_name = name + "_" + str(number)
+                number += 1
+            names.add(unique_name)
+            records.append(SequenceRecord(unique_name, title, codes_to_sequence(codes), parameters))
+    return records
+
+
+"""
+Function that estimates the relative cost of simulating one replicate of a model for a sequence: the number of sites
+times the number of generations it is predicted to take to reach the threshold (the largest of a list of thresholds)
+"""
+def expected_task_cost(model: str, nucleotide_sequence: list, generations_per_step: int = 1,
+                       parameters: dict = None, threshold=None) -> float:
+    if isinstance(threshold, (list, tuple)):
+        threshold = max(threshold)
+    prediction = predict_generations(model, nucleotide_sequence, generations_per_step, parameters, threshold)
+    return len(nucleotide_sequence) * prediction["generations"]
+
+
+"""
+Function that runs replicate tasks across one pool of worker processes, handing them out one at a time in order of
+decreasing expected cost, and serving them from the results store if one is given. Returns the results in task order.
+"""
+def run_longest_first(tasks: list, costs: list, workers: int = None, store=None) -> list:
+    order = sorted(range(len(tasks)), key=lambda index: costs[index], reverse=True)
+    ordered_tasks = [tasks[index] for index in order]
+    if store is not None:
+        ordered_results = run_stored_tasks(ordered_tasks, store, workers, chunksize=1)
+    else:
+        ordered_results = run_tasks(ordered_tasks, workers, chunksize=1)
+
+    results = [None] * len(tasks)
+    for index, result in zip(order, ordered_results):
+        results[index] = result
+    return results
+
+
+"""
+Function to simulate n replicates of each model for every sequence record across one shared pool of worker processes,
+starting the tasks expected to take longest first. Given a checkpoint directory, the simulations save checkpoints there
+and resume from them when the same batch is run again. Given a results store (see results_store.py), the replicates
+already in it are read from it instead of being simulated, and the new ones are added to it. Each record is simulated
+(and its cost estimated) with its own mutation rates if it has them, and with the given parameters otherwise, and draws
+from its own seed stream (see seed_stream), named after the record, so the replicates of different records (even of
+the same sequence) are independent.
+
+Returns a dictionary keyed by record name of the (distances_by_model, generations_by_model) of each record, in the
+order the records were given
+"""
+def run_sequences(records: list, models: list = MODELS, n_replicates: int = 20, workers: int = None,
+                  master_seed: int = 0, engine: str = "numpy", generations_per_step: int = 1,
+                  parameters: dict = None, threshold: float = None, keep_distances: bool = False,
+                  checkpoint_directory: str = None, store=None) -> dict:
+    tasks = []
+    costs = []
+    for record in records:
+        tasks += replicate_tasks(record.nucleotide_sequence, models, n_replicates, master_seed, engine,
+                                 generations_per_step, record.rates(parameters), threshold, keep_distances,
+                                 checkpoint_directory, seed_stream(record.name))
+        model_costs = {model: expected_task_cost(model, record.nucleotide_sequence, generations_per_step,
+                                                 record.rates(parameters), threshold)
+                       for model in models}
+        costs += [model_costs[model] for model in models for replicate in range(n_replicates)]
+    results = run_longest_first(tasks, costs, workers, store)
+
+    tasks_per_record = len(models) * n_replicates
+    return {record.name: gather_results(results[number * tasks_per_record:(number + 1) * tasks_per_record],
+                                        models, n_replicates, keep_distances)
+            for number, record in enumerate(records)}
+
+
+"""
+Function like run_sequences, but instead of a fixed number of replicates, each model of each record keeps getting more
+replicates until the 95% confidence interval of its mean number of generations reaches no further than precision (a
+fraction of the mean) either side of the mean, or it has max_replicates. Every model starts with min_replicates. After
+each round, the number of replicates a model that is not precise enough yet needs is projected from the width of its
+confidence interval (the width shrinks with the square root of the number of replicates), at most doubling its
+replicates so one noisy round does not overshoot, and the new replicates of every record and model are run together in
+one pool, longest expected first. Each replicate has its own seed (see replicate_seed), so they are the same replicates
+a fixed run would simulate, and the number each model gets does not depend on the number of workers.
+
+Returns the same dictionary as run_sequences, with as many replicates of each model as it needed
+"""
+def run_sequences_adaptive(records: list, models: list = MODELS, precision: float = 0.05, min_replicates: int = 5,
+                           max_replicates: int = 100, workers: int = None, master_seed: int = 0,
+                           engine: str = "numpy", generations_per_step: int = 1, parameters: dict = None,
+                           threshold: float = None, keep_distances: bool = False, checkpoint_directory: str = None,
+                           store=None) -> dict:
+    if precision <= 0:
+        raise ValueError("The precision must be a positive fraction of the mean, not " + str(precision))
+    if min_replicates < 2 or max_replicates < min_replicates:
+        raise ValueError("Expected 2 <= min_replicates <= max_replicates, not " + str(min_replicates) + " and " +
+                         str(max_replicates))
+    if isinstance(threshold, (list, tuple)):
+        raise ValueError("Adaptive replicates need a single genetic distance threshold")
+
+    results = {record.name: {model: [] for model in models} for record in records}
+    costs = {(record.name, model): expected_task_cost(model, record.nucleotide_sequence, generations_per_step,
+                                                      record.rates(parameters), threshold)
+             for record in records for model in models}
+    ## the number of replicates each record and model that is not precise enough yet should have after the next round
+    wanted = {(record.name, model): min_replicates for record in records for model in models}
+
+    while wanted:
+        tasks = []
+        task_costs = []
+        task_names = []
+        for record in records:
+            for model in models:
+                if (record.name, model) not in wanted:
+                    continue
+                done = len(results[record.name][model])
+                new_tasks = replicate_tasks(record.nucleotide_sequence, [model], wanted[record.name, model],
+                                            master_seed, engine, generations_per_step, record.rates(parameters),
+                                            threshold, keep_distances, checkpoint_directory,
+                                            seed_stream(record.name))[done:]
+                tasks += new_tasks
+                task_costs += [costs[record.name, model]] * len(new_tasks)
+                task_names += [record.name] * len(new_tasks)
+
+        ## the tasks of each record and model are in replicate order, and so are their results
+        for name, (model, replicate, result) in zip(task_names, run_longest_first(tasks, task_costs, workers, store)):
+            results[name][model].append(result)
+
+        for name, model in list(wanted):
+            generations = [len(result) if keep_distances else result for result in results[name][model]]
+            summary = summarize_generations({model: generations})[model]
+            half_width = (summary["ci_high"] - summary["ci_low"]) / 2
+            target = precision * summary["mean"]
+            replicates = len(generations)
+            if half_width <= target or replicates >= max_replicates:
+                del wanted[name, model]
+            else:
+                projected = math.ceil(replicates * (half_width / target) ** 2)
+                wanted[name, model] = min(max_replicates, 2 * replicates, max(replicates + 1, projected))
+
+    gathered = {}
+    for record in records:
+        distances_by_model = dict(results[record.name]) if keep_distances else {}
+        generations_by_model = {model: [len(result) if keep_distances else result
+                                        for result in results[record.name][model]] for model in models}
+        gathered[record.name] = (distances_by_model, generations_by_model)
+    return gathered
@@ -0,0 +1,186 @@
+"""
+This file runs parameter sweeps: a whole grid of gene x model x mutation rate scale x genetic distance threshold
+simulations in one scheduled batch, instead of hand editing the constants in evolutionary_models.py and restarting the
+program for every combination.
+
+The mutation rates of each gene are read from its mutation rate txt file, and each gene's sequence is read from its
+sequence txt file, once at the start of the sweep. Every replicate of every grid point is then handed to the same pool of
+worker processes, where the compiled model tables are cached, so each combination of rates is only compiled once per
+worker.
+
+Every threshold of the sweep is recorded during the same simulation, which only stops once the largest threshold is
+reached, so adding thresholds to the sweep does not add simulations. Each gene and rate scale draws from its own seed
+stream (see seed_stream in parallel_runner.py), so the replicates of different grid points are independent.
+
+The results are written to a csv file with one row per replicate and threshold: the gene, model, rate scale, threshold,
+replicate number, the number of simulated generations it took to reach the threshold, and the number of real
+generations each simulated generation stands for (from the note in the mutation rate file). With --store, the replicates are also saved
+to a SQLite results store (see results_store.py), and any grid point already in it is not simulated again.
+
+With --expectation-only, nothing is simulated: each grid point gets one row with the number of generations predicted
+to reach each threshold (see predictor.py) in place of the replicates, and its approximate standard deviation, for quick
+scans of many parameters.
+
+Example:
+    python sweep.py --models JC GTR --rate-scales 0.5 1 2 --thresholds 0.5 0.749 --replicates 20 --output sweep.csv
+    python sweep.py --rate-scales 0.25 0.5 1 2 4 --thresholds 0.5 0.7 0.749 --expectation-only --output expected.csv
+"""
+
+import argparse
+import csv
+import itertools
+import os
+
+from evolutionary_models import MODELS, threshold_genetic_distance
+from parallel_runner import replicate_tasks, run_tasks, seed_stream
+from predictor import predict_generations
+from results_store import ResultsStore, run_stored_tasks
+from validate_input import load_sequence, read_generations_per_rate, read_mutation_rates
+
+## The directory the gene files are in (file names are looked up relative to it, unless they are absolute paths)
+DATA_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+## The genes of the study, with their sequence file and mutation rate file
+GENES = {
+    "HIV Gag": ("HIV_gag_sequence.txt", "hiv_gag_mutation_rates.txt"),
+    "Drosophila white": ("drosophila_white_sequence.txt", "drosophila_white_mutation_rates.txt"),
+    "Yeast YML093W": ("yeast_yml093w_sequence.txt", "yeast_yml093w_mutation_rates.txt"),
+}
+
+
+"""
+Function that loads the sequence, mutation rates and generations per rate of each gene, once for the whole sweep
+"""
+def load_genes(genes: dict) -> dict:
+    loaded_genes = {}
+    for gene, (sequence_file, rates_file) in genes.items():
+        sequence_file = os.path.join(DATA_DIRECTORY, sequence_file)
+        rates_file = os.path.join(DATA_DIRECTORY, rates_file)
+        nucleotide_sequence = load_sequence(sequence_file)
+        if nucleotide_sequence == "Error":
+            raise ValueError("Could not load the sequence of " + gene + " from " + sequence_file)
+        loaded_genes[gene] = (nucleotide_sequence, read_mutation_rates(rates_file),
+                              read_generations_per_rate(rates_file))
+    return loaded_genes
+
+
+"""
+Function that multiplies every mutation rate by the same scale
+"""
+def scale_rates(rates: dict, rate_scale: float) -> dict:
+    return {name: rate * rate_scale for name, rate in rates.items()}
+
+
+"""
+Function to run the whole sweep grid, spread across the given number of worker processes. Returns a list of result
+rows, one per replicate, as dictionaries with the same keys as the columns of the csv file. Replicates already in the
+results store, if one is given, are read from it instead of being simulated.
+"""
+def run_sweep(genes: dict = GENES, models: list = MODELS, rate_scales: list = (1.0,),
+              thresholds: list = (threshold_genetic_distance,), n_replicates: int = 20, workers: int = None,
+              master_seed: int = 0, engine: str = "numpy", store: ResultsStore = None) -> list:
+    loaded_genes = load_genes(genes)
+
+    ## every simulation records all of the thresholds, so the thresholds are not part of the grid of simulations
+    grid = list(itertools.product(loaded_genes, models, rate_scales))
+    tasks = []
+    for gene, model, rate_scale in grid:
+        nucleotide_sequence, rates, generations_per_rate = loaded_genes[gene]
+        tasks += replicate_tasks(nucleotide_sequence, [model], n_replicates, master_seed, engine,
+                                 parameters=scale_rates(rates, rate_scale), threshold=list(thresholds),
+                                 keep_distances=False, stream=seed_stream(gene, float(rate_scale)))
+
+    ## the results come back in task order, which is grid order with the replicates of each grid point together
+    results = run_stored_tasks(tasks, store, workers) if store is not None else run_tasks(tasks, workers)
+    rows = []
+    for index, (gene, model, rate_scale) in enumerate(grid):
+        replicate_results = results[index * n_replicates:(index + 1) * n_replicates]
+        for threshold in thresholds:
+            for task_model, replicate, crossings in replicate_results:
+                rows.append({"gene": gene, "model": model, "rate_scale": rate_scale, "threshold": threshold,
+                             "replicate": replicate, "generations": crossings[threshold],
+                             "generations_per_item": loaded_genes[gene][2]})
+    return rows
+
+
+"""
+Function for the expectation only mode of the sweep: instead of simulating replicates, predicts the number of
+generations each grid point takes to reach each threshold. Returns one result row per grid point and threshold, with
+"expected" as the replicate and the approximate standard deviation of the number of generations in generations_sd.
+"""
+def run_expected_sweep(genes: dict = GENES, models: list = MODELS, rate_scales: list = (1.0,),
+                       thresholds: list = (threshold_genetic_distance,)) -> list:
+    loaded_genes = load_genes(genes)
+
+    rows = []
+    for gene, model, rate_scale in itertools.product(loaded_genes, models, rate_scales):
+        nucleotide_sequence, rates, generations_per_rate = loaded_genes[gene]
+        predictions = predict_generations(model, nucleotide_sequence, parameters=scale_rates(rates, rate_scale),
+                                          threshold=list(thresholds))
+        for threshold in thresholds:
+            rows.append({"gene": gene, "model": model, "rate_scale": rate_scale, "threshold": threshold,
+                         "replicate": "expected", "generations": round(predictions[threshold]["generations"], 1),
+                         "generations_per_item": generations_per_rate,
+                         "generations_sd": round(predictions[threshold]["sd"], 1)})
+    return rows
+
+
+"""
+Function that writes the result rows of a sweep to a csv file (with the standard deviation column too for the rows of
+an expectation only sweep)
+"""
+def write_sweep_results(rows: list, file_name: str):
+    fieldnames = ["gene", "model", "rate_scale", "threshold", "replicate", "generations", "generations_per_item"]
+    if rows and "generations_sd" in rows[0]:
+        fieldnames.append("generations_sd")
+    with open(file_name, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+"""
+Function that groups the result rows of a sweep into a generations_by_model dictionary for each gene, rate scale and
+threshold, in the same shape the main program prints
+"""
+def generations_by_grid_point(rows: list) -> dict:
+    grouped = {}
+    for row in rows:
+        point = (row["gene"], row["rate_scale"], row["threshold"])
+        grouped.setdefault(point, {}).setdefault(row["model"], []).append(row["generations"])
+    return grouped
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a gene x model x rate scale x threshold parameter sweep")
+    parser.add_argument("--genes", nargs="+", choices=list(GENES), default=list(GENES))
+    parser.add_argument("--models", nargs="+", choices=MODELS, default=MODELS)
+    parser.add_argument("--rate-scales", nargs="+", type=float, default=[1.0])
+    parser.add_argument("--thresholds", nargs="+", type=float, default=[threshold_genetic_distance])
+    parser.add_argument("--replicates", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--engine", default="numpy")
+    parser.add_argument("--output", default="sweep_results.csv")
+    parser.add_argument("--store", default=None, help="SQLite results store to save to and serve repeats from")
+    parser.add_argument("--expectation-only", action="store_true",
+                        help="predict the number of generations of each grid point instead of simulating replicates")
+    arguments = parser.parse_args()
+
+    genes = {gene: GENES[gene] for gene in arguments.genes}
+    if arguments.expectation_only:
+        rows = run_expected_sweep(genes, arguments.models, arguments.rate_scales, arguments.thresholds)
+    else:
+        store = ResultsStore(arguments.store) if arguments.store is not None else None
+        rows = run_sweep(genes, arguments.models, arguments.rate_scales, arguments.thresholds, arguments.replicates,
+                         arguments.workers, arguments.seed, arguments.engine, store)
+        if store is not None:
+            store.close()
+    write_sweep_results(rows, arguments.output)
+
+    for (gene, rate_scale, threshold), generations_by_model in generations_by_grid_point(rows).items():
+        print(gene, "rate scale", rate_scale, "threshold", threshold, "\n", generations_by_model)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""
+This file provides a compact way to store the genetic distances by generation of long simulations.
+
+A Trajectory can be handed to the simulation engines in place of the plain list of distances. It is appended to one
+generation at a time like the list, and len() still gives the number of generations, but the distances are kept as
+float32 in fixed size chunks instead of as a Python list of floats. For very long runs only every stride-th generation
+can be kept, or the smallest and largest distance of every block of stride generations (min-max decimation, which keeps
+the spread of the trajectory visible on a plot). The completed chunks can also be spilled to a file that is memory
+mapped back when the distances are read, so the memory used stays flat however long the simulation runs.
+
+Whatever is kept, the number of generations and the last generation (where the consensus generations reached the
+genetic distance threshold) are always exact.
+
+A finished Trajectory can be made compact (only its kept points and number of generations) to send back from a worker
+process, as the replicates of a batch are when their distances are kept for plotting (see parallel_runner.py).
+
+A Trajectory can also be saved in a checkpoint and restored from it (see checkpoint.py). The values already spilled to
+the file stay there: the checkpoint only records how many of them there were, and the file is cut back to that many
+when the trajectory is restored.
+"""
+
+import os
+
+import numpy as np
+
+
+class Trajectory:
+    def __init__(self, stride: int = 1, decimation: str = "stride", spill_path: str = None, chunk_size: int = 65536):
+        if decimation not in ("stride", "minmax"):
+            raise ValueError("Unknown decimation '" + str(decimation) + "', expected 'stride' or 'minmax'")
+        if stride < 1:
+            raise ValueError("The stride must be at least 1")
+
+        self.stride = stride
+        self.decimation = decimation
+        self.spill_path = spill_path
+        self.generations = 0
+        self.last_distance = None
+
+        ## the chunk being filled, the completed chunks kept in memory, and the number of values spilled to the file
+        self.chunk = np.empty(chunk_size, dtype=np.float32)
+        self.chunk_used = 0
+        self.chunks = []
+        self.spilled = 0
+        ## the spill file is only opened once the first chunk is spilled, so a trajectory being restored from a
+        ## checkpoint does not empty the file first
+        self.spill_file = None
+
+        ## the smallest and largest distance of the current block of generations, for min-max decimation
+        self.block_min = None
+        self.block_max = None
+
+    ## record the genetic distance of the next generation
+    def append(self, distance: float):
+        position = self.generations % self.stride
+        self.generations += 1
+        self.last_distance = distance
+
+        if self.decimation == "stride":
+            if position == 0:
+                self.store(distance)
+            return
+
+        if position == 0:
+            self.block_min = self.block_max = distance
+        else:
+            self.block_min = min(self.block_min, distance)
+            self.block_max = max(self.block_max, distance)
+        if position == self.stride - 1:
+            self.store(self.block_min)
+            self.store(self.block_max)
+
+    def store(self, value: float):
+        self.chunk[self.chunk_used] = value
+        self.chunk_used += 1
+        if self.chunk_used == len(self.chunk):
+            self.flush()
+
+    ## move the filled part of the current chunk to the spill file, or to the list of completed chunks
+    def flush(self):
+        if self.chunk_used == 0:
+            return
+        if self.spill_path is not None:
+            if self.spill_file is None:
+                self.spill_file = open(self.spill_path, 'wb')
+            self.spill_file.write(self.chunk[:self.chunk_used].tobytes())
+            self.spilled += self.chunk_used
+        else:
+            self.chunks.append(self.chunk[:self.chunk_used].copy())
+        self.chunk_used = 0
+
+    def __len__(self) -> int:
+        return self.generations
+
+    ## the generation the simulation stopped at, where the consensus generations reached the threshold
+    @property
+    def crossing_generation(self) -> int:
+        return self.generations - 1
+
+    ## all of the stored values in order, with the spilled ones memory mapped from the file
+    def stored_values(self) -> np.ndarray:
+        parts = []
+        if self.spilled > 0:
+            if not self.spill_file.closed:
+                self.spill_file.flush()
+            parts.append(np.memmap(self.spill_path, dtype=np.float32, mode='r', shape=(self.spilled,)))
+        parts += self.chunks
+        parts.append(self.chunk[:self.chunk_used])
+        return np.concatenate(parts)
+
+    """
+    Returns the generations and genetic distances of the kept points as two arrays, ready to plot. The last generation
+    is always included with its exact distance.
+    """
+    def points(self) -> tuple:
+        distances = self.stored_values()
+
+        if self.decimation == "stride":
+            generations = np.arange(len(distances), dtype=np.int64) * self.stride
+        else:
+            generations = np.repeat(np.arange(len(distances) // 2, dtype=np.int64) * self.stride, 2)
+            ## the last block may not be full yet
+            if self.generations % self.stride != 0:
+                block_start = self.generations - self.generations % self.stride
+                generations = np.append(generations, [block_start, block_start])
+                distances = np.append(distances, np.array([self.block_min, self.block_max], dtype=np.float32))
+
+        if self.generations > 0 and (len(generations) == 0 or generations[-1] != self.crossing_generation):
+            generations = np.append(generations, self.crossing_generation)
+            distances = np.append(distances, np.float32(self.last_distance))
+        return generations, distances
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        distances = self.points()[1]
+        return distances if dtype is None else distances.astype(dtype)
+
+    ## the state of the trajectory to save in a checkpoint, with the spilled values made durable in their file first
+    def get_state(self) -> dict:
+        if self.spill_file is not None and not self.spill_file.closed:
+            self.spill_file.flush()
+            os.fsync(self.spill_file.fileno())
+        state = {name: np.nan if getattr(self, name) is None else getattr(self, name)
+                 for name in ("last_distance", "block_min", "block_max")}
+        state.update({"generations": self.generations, "spilled": self.spilled,
+                      "values": np.concatenate(self.chunks + [self.chunk[:self.chunk_used]])})
+        return state
+
+    ## restore the trajectory from a checkpoint, cutting the spill file back to the values spilled when it was saved
+    def set_state(self, state: dict):
+        self.generations = int(state["generations"])
+        for name in ("last_distance", "block_min", "block_max"):
+            setattr(self, name, None if np.isnan(state[name]) else float(state[name]))
+
+        self.spilled = int(state["spilled"])
+        if self.spilled > 0:
+            self.spill_file = open(self.spill_path, 'r+b')
+            self.spill_file.truncate(self.spilled * self.chunk.itemsize)
+            self.spill_file.seek(0, 2)
+
+        ## the values that were still in memory go back into the current chunk, spilling as it fills
+        self.chunks = []
+        self.chunk_used = 0
+        for value in state["values"]:
+            self.store(value)
+
+    ## close the spill file once the simulation is finished (the stored values can still be read afterwards)
+    def close(self):
+        if self.spill_path is not None:
+            self.flush()
+        if self.spill_file is not None and not self.spill_file.closed:
+            self.spill_file.close()
+
+    ## the kept points and the number of generations of the trajectory, without its chunk buffers, to send back from a
+    ## worker process
+    def compact(self):
+        return TrajectoryPoints(self.generations, *self.points())
+
+
+"""
+The kept points of a trajectory together with its number of generations, read like a Trajectory (len() is the number
+of generations, and points() the generations and genetic distances to plot) but small to send between processes
+"""
+class TrajectoryPoints:
+    def __init__(self, generations: int, x: np.ndarray, y: np.ndarray):
+        self.generations = generations
+        self.x = x
+        self.y = y
+
+    def __len__(self) -> int:
+        return self.generations
+
+    def points(self) -> tuple:
+        return self.x, self.y
+
+    ## whether every generation was kept, so the distances are the whole genetic distance by generation
+    def is_complete(self) -> bool:
+        return np.array_equal(self.x, np.arange(self.generations))
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        return self.y if dtype is None else self.y.astype(dtype)
@@ -1,13 +1,61 @@
 """
 This file gets the user-input file, opens it, and validates that the data is clean. It also capitalizes the nucleotide
 sequence for greater consistency.
+
+Whole FASTA files with many records (or chromosome-scale sequences) can be streamed one record at a time from a memory
+mapped file. Each record is validated and encoded straight into a uint8 array of nucleotide codes with bulk byte
+operations, without ever building a string of the sequence.
+
+It also reads the mutation rate txt files of the genes, so the model parameters can be loaded from them instead of being
+copy and pasted into evolutionary_models.py.
 """
 
+import ast
+import mmap
+import re
+
+import numpy as np
+
+from evolutionary_models import NUCLEOTIDES
+
+## lookup table from byte to nucleotide code (in the order of NUCLEOTIDES, either case), with whitespace and illegal
+## characters marked by their own codes
+WHITESPACE_CODE = 254
+INVALID_CODE = 255
+SEQUENCE_BYTE_CODES = np.full(256, INVALID_CODE, dtype=np.uint8)
+for code, nucleotide in enumerate(NUCLEOTIDES):
+    SEQUENCE_BYTE_CODES[ord(nucleotide)] = code
+    SEQUENCE_BYTE_CODES[ord(nucleotide.lower())] = code
+for whitespace in b" \t\n\r":
+    SEQUENCE_BYTE_CODES[whitespace] = WHITESPACE_CODE
+
+## the capital letter of each nucleotide code
+NUCLEOTIDE_LETTERS = np.frombuffer("".join(NUCLEOTIDES).encode("ascii"), dtype=np.uint8)
+
+
+"""
+Error raised when a sequence contains a character that is not a legal nucleotide. It records the character, its index
+in the sequence once whitespace is removed, and (when reading a FASTA file) the record it is in and its byte offset in
+the file.
+"""
+class InvalidNucleotideError(ValueError):
+    def __init__(self, character: str, index: int, record: str = None, file_offset: int = None):
+        self.character = character
+        self.index = index
+        self.record = record
+        self.file_offset = file_offset
+        message = "Invalid DNA sequence: found character '" + character + "' at index " + str(index)
+        if record is not None:
+            message += " of record '" + record + "' (byte " + str(file_offset) + " of the file)"
+        super().__init__(message)
+
+
 """
-Function to get the user input from a text file
+Function to get the user input from a text file, asking the user for the name of the file unless it is given
 """
-def read_file() -> str:
-    file_name = input("Please enter the name of the file txt file to input: ")
+def read_file(file_name: str = None) -> str:
+    if file_name is None:
+        file_name = input("Please enter the name of the file txt file to input: ")
     try:
         file = open(file_name, 'r')
 
@@ -36,34 +84,180 @@ def read_file() -> str:
         file.close()
 
 
+"""
+Function that validates raw sequence bytes (as a uint8 array) and encodes them into nucleotide codes in one pass over a
+lookup table, dropping tabs, spaces and newlines. Raises an InvalidNucleotideError for the first illegal character, with
+its index in the sequence once whitespace is removed and its offset in the raw bytes.
+"""
+def encode_nucleotide_bytes(raw_bytes: np.ndarray) -> np.ndarray:
+    codes = SEQUENCE_BYTE_CODES[raw_bytes]
+    is_whitespace = codes == WHITESPACE_CODE
+
+    first_invalid = int(np.argmax(codes == INVALID_CODE)) if len(codes) > 0 else 0
+    if len(codes) > 0 and codes[first_invalid] == INVALID_CODE:
+        index = first_invalid - int(np.count_nonzero(is_whitespace[:first_invalid]))
+        raise InvalidNucleotideError(chr(raw_bytes[first_invalid]).upper(), index, file_offset=first_invalid)
+
+    return codes[~is_whitespace]
+
+
+"""
+Function that converts an array of nucleotide codes into the list of capital letters the simulations use
+"""
+def codes_to_sequence(codes: np.ndarray) -> list:
+    return list(NUCLEOTIDE_LETTERS[codes].tobytes().decode("ascii"))
+
+
 """
 Function to validate the user input DNA sequence to ensure it only
 contains legal nucleotides. Returns false if input is not legal, and
 returns capitalized sequence if legal input.
 """
 def validate_nucleotide_sequence(raw_DNA_input: str) -> str:
-   # capitalize the input to allow for capitalization flexibility, and to
-   # standardize the input for validation and interpretation
-
-   capitalized_DNA = raw_DNA_input.upper()
-   # remove all tabs, spaces, and newlines
-   capitalized_DNA = capitalized_DNA.replace("\n", "")
-   capitalized_DNA = capitalized_DNA.replace("\t", "")
-   capitalized_DNA = capitalized_DNA.replace(" ", "")
+   # encode the input one byte per character (any character that is not ASCII cannot be a nucleotide), then check and
+   # capitalize every character at once, removing all tabs, spaces, and newlines
+   raw_bytes = np.frombuffer(raw_DNA_input.encode("ascii", errors="replace"), dtype=np.uint8)
 
-   legal_nucleotides = set(['A', 'C', 'G', 'T'])
+   try:
+       codes = encode_nucleotide_bytes(raw_bytes)
+   except InvalidNucleotideError as error:
+       print("Invalid DNA sequence: found character '", raw_DNA_input[error.file_offset].upper(),
+             "' at index", error.index)
+       return "Error"
 
-   for i in range(0, len(capitalized_DNA)):
-       # check that each nucleotide is legal
-       if capitalized_DNA[i] not in legal_nucleotides:
-           print("Invalid DNA sequence: found character '", capitalized_DNA[i],
-                 "' at index", i)
-           return "Error"
-
-   return list(capitalized_DNA)
+   return codes_to_sequence(codes)
 
 def validate_input():
     ## get the file input of initial DNA sequence for each haploid individual
     raw_data = read_file()
     ## validate the input and return the validated sequence
     return validate_nucleotide_sequence(raw_data)
+
+
+"""
+Function to read and validate the nucleotide sequence in the named file without asking the user for anything.
+Returns "Error" if the file could not be read or the sequence is not legal.
+"""
+def load_sequence(file_name: str):
+    raw_data = read_file(file_name)
+    if raw_data == "Error":
+        return "Error"
+    return validate_nucleotide_sequence(raw_data)
+
+
+"""
+Function that streams the records of a FASTA file one at a time from a memory mapped file, yielding the header of each
+record (without the ">") and its sequence validated and encoded as a uint8 array of nucleotide codes. A file without
+any header line is read as a single record with an empty header. Raises an InvalidNucleotideError naming the record,
+the index in its sequence and the byte offset in the file of the first illegal character.
+"""
+def read_fasta_records(file_name: str):
+    with open(file_name, 'rb') as file:
+        ## an empty file cannot be memory mapped, and has no records anyway
+        if file.seek(0, 2) == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            size = len(data)
+            position = 0
+            while position < size:
+                ## the header runs to the end of its line, and the sequence runs to the next header (or the end)
+                if data[position:position + 1] == b">":
+                    header_end = data.find(b"\n", position)
+                    header_end = size if header_end == -1 else header_end
+                    header = data[position + 1:header_end].decode("utf-8", errors="replace").strip()
+                    sequence_start = min(header_end + 1, size)
+                else:
+                    header = ""
+                    sequence_start = position
+
+                sequence_end = data.find(b"\n>", sequence_start - 1 if sequence_start > 0 else 0)
+                sequence_end = size if sequence_end == -1 else sequence_end + 1
+
+                raw_bytes = np.frombuffer(data, dtype=np.uint8, count=sequence_end - sequence_start,
+                                          offset=sequence_start)
+                invalid = None
+                try:
+                    codes = encode_nucleotide_bytes(raw_bytes)
+                except InvalidNucleotideError as error:
+                    invalid = (error.character, error.index, sequence_start + error.file_offset)
+                ## release the view of the memory map (the caught error's traceback is gone too) so it can be closed
+                del raw_bytes
+                if invalid is not None:
+                    raise InvalidNucleotideError(invalid[0], invalid[1], header, invalid[2])
+
+                yield header, codes
+                position = sequence_end
+
+
+"""
+Function to evaluate the right hand side of a mutation rate assignment, which may only use numbers, the rates assigned
+before it, brackets, and + - * / **
+"""
+def evaluate_rate_expression(node, rates: dict):
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+        return node.value
+    if isinstance(node, ast.Name) and node.id in rates:
+        return rates[node.id]
+    if isinstance(node, ast.Tuple):
+        return tuple(evaluate_rate_expression(element, rates) for element in node.elts)
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.UAdd, ast.USub)):
+        value = evaluate_rate_expression(node.operand, rates)
+        return value if isinstance(node.op, ast.UAdd) else -value
+    if isinstance(node, ast.BinOp) and type(node.op) in RATE_OPERATORS:
+        return RATE_OPERATORS[type(node.op)](evaluate_rate_expression(node.left, rates),
+                                             evaluate_rate_expression(node.right, rates))
+    raise ValueError("Unsupported expression in mutation rate file: " + ast.dump(node))
+
+
+## the arithmetic a mutation rate file may use
+RATE_OPERATORS = {
+    ast.Add: lambda left, right: left + right,
+    ast.Sub: lambda left, right: left - right,
+    ast.Mult: lambda left, right: left * right,
+    ast.Div: lambda left, right: left / right,
+    ast.Pow: lambda left, right: left ** right,
+}
+
+
+"""
+Function that reads the model parameters out of a gene's mutation rate txt file. The file's user defined constants
+(e.g. "JC_alpha = 2.8 * 0.0001" or "K2P_alpha, HKY85_alpha = (.539 * JC_alpha * 2), (.539 * JC_alpha * 2)") are
+evaluated in order, so later rates can refer to earlier ones. Returns a dictionary of rates keyed by the names of the
+constants in evolutionary_models.py, and raises a ValueError if an assignment cannot be understood.
+"""
+def read_mutation_rates(file_name: str) -> dict:
+    rates = {}
+    with open(file_name, 'r') as file:
+        for line_number, line in enumerate(file, start=1):
+            line = line.strip()
+            ## only lines that assign to one or more constant names are parameters, everything else is notes
+            if not re.match(r"^[A-Za-z_]\w*(\s*,\s*[A-Za-z_]\w*)*\s*=", line):
+                continue
+            try:
+                assignment = ast.parse(line).body[0]
+                names = assignment.targets[0]
+                values = evaluate_rate_expression(assignment.value, rates)
+            except (SyntaxError, ValueError) as error:
+                raise ValueError("Could not read mutation rate on line " + str(line_number) + " of " + file_name +
+                                 ": " + str(error))
+
+            if isinstance(names, ast.Tuple):
+                for name, value in zip(names.elts, values):
+                    rates[name.id] = value
+            else:
+                rates[names.id] = values
+    return rates
+
+
+"""
+Function that reads how many real generations the rates in a gene's mutation rate txt file are given per, from the
+note above the Jukes-Cantor rate (e.g. "per nucleotide per 10^5 generations"). Returns 1 if the file does not say.
+"""
+def read_generations_per_rate(file_name: str) -> int:
+    with open(file_name, 'r') as file:
+        match = re.search(r"per nucleotide per (?:10\^(\d+)|(\d+)) generation", file.read())
+    if match is None:
+        return 1
+    if match.group(1) is not None:
+        return 10 ** int(match.group(1))
+    return int(match.group(2))